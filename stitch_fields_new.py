@@ -9,15 +9,31 @@ Joel 2015-04-03
 from __future__ import print_function
 from __future__ import division
 from skimage import exposure #only for rescaling now, maybe replace PIL completely in the future
-from itertools import cycle
+from itertools import cycle, groupby
+from bisect import bisect_left
 from PIL import Image # could be either pillow or PIL?
-from itertools import cycle
-from PIL import Image
+from collections import namedtuple, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8, the worker processes save their wells themselves
+    shared_memory = None
 import numpy as np
 import argparse
+import io
+import atexit
+import hashlib
+import json
 import logging
+import random
 import shutil
+import struct
+import tarfile
+import tempfile
+import threading
 import time
+import zipfile
+import zlib
 import sys
 import re
 import os
@@ -40,7 +56,10 @@ def main():
         'same directory:\n\npython stitch_fields.py -cr -f <field_prefix> -w <well_prefix>',
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('path', default=os.getcwd(), nargs='?',
-        help='path to images  (default: current directory)')
+        help='path to images, or a zip or tar file of them (default: current directory).\n' \
+        'A compressed tar file can only be read front to back: a field stored before the last\n' \
+        'one read decompresses the archive from the start again, which makes large plates slow.\n' \
+        'Use zip or an uncompressed tar file for those')
     parser.add_argument('-o', '--output-format', nargs='?', default='jpeg',
         help='format for the stitched image (default: %(default)s)')
     parser.add_argument('-i', '--input-format', nargs='?', default='bmp',
@@ -51,6 +70,10 @@ def main():
         help='string immediately preceding the well id in the file name (default: %(default)s)')
     parser.add_argument('-c', '--channel-prefix', default='d',
         help='string immediately preceding the channel id in the file name (default: %(default)s)')
+    parser.add_argument('-t', '--name-template', default=None,
+        help='template for the field file names, replaces -f, -w and -c, e.g.\n' \
+        '{plate}_{well:A01}f{field:d}d{channel:d}.{ext}\n' \
+        '(default: built from the well, field and channel prefixes)')
     parser.add_argument('-d', '--scan-direction', nargs='?', default='left_down',
         help='The directions from the 1st field to the 2nd and 3rd, e.g. left_down =\n' \
         '9, 8, 7, \n' \
@@ -69,7 +92,53 @@ def main():
         'Find the ~max (99.999th percentile in the entire plate and scales everything accordingly.' \
         'Now we can export 16-bit tiff files instead of converting to 8 bit in cellomics, which would ' \
         'makes them appear patchy.')
+    parser.add_argument('--intensity-sample', type=float, default=None, metavar='FRACTION',
+        help='with -s, estimate the max intensity once for the whole plate from this fraction of\n' \
+        'the fields of every well (e.g. 0.1) and rescale all wells with it in a single read.\n' \
+        'The estimate is stored in ' + INTENSITY_FILE + ' (default: per well from all its fields)')
     parser.add_argument('--flip', default='none', choices=['horizontal', 'vertical', 'both', 'none'])
+    parser.add_argument('-j', '--workers', type=int, default=1,
+        help='number of wells to stitch at the same time (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads that decode and place the fields of one well at the same time,\n' \
+        'also inside each of the -j workers and for wells stitched one field at a time\n' \
+        '(default: %(default)s)')
+    parser.add_argument('--field-cache', default=None, metavar='DIR',
+        help='keep decoded fields as .npy files in DIR, preferably on a local SSD, so later runs\n' \
+        'of the same plate map them instead of decoding again (default: no cache)')
+    parser.add_argument('--field-cache-size', type=parse_size, default='20G',
+        help='size the field cache is kept under, the least recently used fields are removed\n' \
+        'first (default: %(default)s)')
+    parser.add_argument('-m', '--memory-budget', type=parse_size, default=None,
+        help='memory that the running wells may use together, e.g. 8G. Wells that can never fit\n' \
+        'are stitched one field at a time instead (default: no limit)')
+    parser.add_argument('--outputs', type=parse_outputs, default=['wells'],
+        help='comma separated outputs to make from one pass over the plate: wells, overview,\n' \
+        'pyramid and/or archive, every well in one ' + ARCHIVE_FILE + ' file (default: wells)')
+    parser.add_argument('--archive-codec', default='raw', choices=ARCHIVE_CODECS,
+        help='how wells are stored in the archive: raw arrays, zlib compressed arrays or image\n' \
+        'files in the output format (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+        help='print the task plan and its estimated cost without stitching anything')
+    parser.add_argument('--projection', default='max', choices=['max', 'mean', 'none'],
+        help='how the z-planes of a field ({z:d} in the name template) are combined. With none,\n' \
+        'every plane is stitched into its own image (default: %(default)s)')
+    parser.add_argument('--preflight', default='off', choices=['off', 'report', 'skip', 'fail'],
+        help='check the headers of all fields and the field numbers of every well before stitching.\n' \
+        'report only prints the problems, skip leaves bad wells out, fail stops (default: %(default)s)')
+    parser.add_argument('--fill-value', type=int, default=0,
+        help='value for the places in the well without a field (default: %(default)s)')
+    parser.add_argument('--roi', type=parse_roi, default=None,
+        help='only cut the region X,Y,WIDTH,HEIGHT (well pixel coordinates) out of each well,\n' \
+        'reading just the fields that overlap it. With -s, also give --intensity-sample')
+    parser.add_argument('--roi-well', default=None,
+        help='well (e.g. B03) or stitched well name to cut the --roi from (default: all wells)')
+    parser.add_argument('--no-geometry-cache', action='store_true',
+        help='recompute the field layouts instead of reusing the ones stored in ' + GEOMETRY_FILE + '\n' \
+        'by earlier timepoints or runs')
+    parser.add_argument('--project-time', action='store_true',
+        help='also project over the timepoints ({t:d} in the name template) instead of\n' \
+        'stitching every timepoint separately')
     #Initialize some variables
     args = parser.parse_args()
     # PIL's image function takes 'jpeg' instead of 'jpg' as an argument. We want to be able to
@@ -78,6 +147,7 @@ def main():
         output_format = 'jpg'
     else:
         output_format = args.output_format.lower()
+    args.output_ext = output_format
    # timestamp = str(int(time.time()))[3:]
     input_format = set((args.input_format.lower(),)) #can add extra ext here is needed, remember to not have same as stiched
     logging.basicConfig(filename='well_stitch.log',level=logging.DEBUG, format='%(message)s')
@@ -86,208 +156,174 @@ def main():
         print(key +'\t', vars(args)[key])
         #logging.info(key +'\t', vars(args)[key])
 
-    # Sort channels and create subfolders
-    channel_names = [''] # if channel_sort is not specified, this helps
-    if args.sort_channels:
-        print('\n Moving images to channel subfolders...')
-        channel_names = sort_channels(args.path, args.channel_prefix, input_format)
-
-    # Sort wells and create subfolders
-    if args.sort_wells:
-        print('\n Moving images to well subfolders...')
-        well_names = sort_wells(args.path, args.well_prefix, input_format, channel_names)
+    # Compile the file name template once, every stage below works on the parsed field table
+    if args.name_template is None:
+        args.name_template = '{plate}' + args.well_prefix + '{well:A01}' + args.field_prefix + \
+            '{field:d}' + args.channel_prefix + '{channel:d}.{ext}'
+    name_template = compile_template(args.name_template)
+
+    if args.field_cache is not None:
+        init_field_cache(args.field_cache, args.field_cache_size)
+    # A zip or tar plate is read in place, the outputs go next to it
+    plate_archive = is_plate_archive(args.path)
+    args.plate_dir = os.path.dirname(os.path.abspath(args.path)) if plate_archive else args.path
+    # Sort wells and/or channels and create subfolders
+    if plate_archive and (args.sort_wells or args.sort_channels):
+        parser.error('the files in a zip or tar plate cannot be sorted into subfolders')
+    if args.sort_wells or args.sort_channels:
+        print('\n Moving images to subfolders...')
+        table = scan_fields(args.path, name_template, input_format)
+        sort_fields(args.path, table, args.sort_wells, args.sort_channels, args.channel_prefix)
 
     # Main program
-    if args.recursive:
-        # Create a new directory. Append a number if it already exists.
+    # Create a new directory. Append a number if it already exists.
+    stitched_dir = os.path.join(args.plate_dir, 'stitched_wells')
+    dir_suffix = 1
+    while os.path.exists(stitched_dir):
+        dir_suffix += 1
+        stitched_dir = os.path.join(args.plate_dir, 'stitched_wells_' + str(dir_suffix))
+    if args.recursive and plate_archive:
+        # The directories in the archive that hold files are the well directories
+        kind, members = plate_members(args.path)
+        well_dirs = sorted(set(args.path + MEMBER_SEPARATOR + os.path.dirname(name) for name in members
+            if os.path.dirname(name)))
+    elif args.recursive:
+        # Loop through only the well directories, the current directory does not need to be
+        # included as the files will already be sorted into subdirectories
+        dirs = [os.path.join(args.path, name) for name in os.listdir(args.path)
+            if os.path.isdir(os.path.join(args.path, name))]
+        well_dirs = [name for name in dirs if not os.path.basename(name).startswith('stitched_wells')]
+    else:
+        well_dirs = [args.path]
+    projected = ()
+    if args.projection != 'none':
+        projected = ('z', 't') if args.project_time else ('z',)
+    # Parse all listings into the field table up front. Each (well, channel) group is stitched
+    # on its own, so a directory holding several wells no longer mixes up their fields.
+    wells = []
+    for dir_name in sorted(well_dirs, key=nat_key):
+        groups = group_fields(scan_fields(dir_name, name_template, input_format), projected)
+        for key, entries in groups.items():
+            if args.recursive and len(groups) == 1:
+                wells.append((os.path.basename(dir_name), entries))
+            else:
+                wells.append((group_name(key, args.channel_prefix), entries))
+    if args.preflight != 'off' and wells:
+        problems = preflight_plate(wells, args)
+        if problems and args.preflight == 'fail':
+            sys.exit('Pre-flight check failed for {0} wells, see {1}'.format(len(problems), 'well_stitch.log'))
+        if args.preflight == 'skip':
+            wells = [(well_name, entries) for well_name, entries in wells if well_name not in problems]
+    # The plate intensity comes from every well, also when --roi-well picks one of them
+    plate_wells = wells
+    if args.roi_well is not None:
+        wells = [(well_name, entries) for well_name, entries in wells
+            if args.roi_well in (well_name, entries[0].well)]
+    if args.roi is not None and args.rescale_intensity and args.intensity_sample is None:
+        # A region only reads some fields, which cannot give the scale of the whole well
+        parser.error('--roi with -s needs --intensity-sample for a max intensity that does not '
+            'depend on the region')
+    if args.fill_value != 0:
+        # The fill value has to fit in the canvas of every well, 0 always does
+        dtypes = set([np.dtype(np.uint8)] if args.rescale_intensity else
+            [well_field_spec(entries)[1] for well_name, entries in wells])
+        for dtype in dtypes:
+            if dtype.kind in 'iu' and not np.iinfo(dtype).min <= args.fill_value <= np.iinfo(dtype).max:
+                parser.error('--fill-value {0} does not fit in the {1} images, use {2} to {3}'.format(
+                    args.fill_value, dtype.name, np.iinfo(dtype).min, np.iinfo(dtype).max))
+            if dtype.kind == 'b' and args.fill_value not in (0, 1):
+                parser.error('--fill-value has to be 0 or 1 for 1-bit images')
+    args.plate_max_int = None
+    geometry = None
+    if not args.no_geometry_cache:
+        geometry = GeometryCache(os.path.join(args.plate_dir, GEOMETRY_FILE))
+    # Anything beyond the plain well images goes through the planner, so each well is only
+    # decoded once however many outputs are made from it
+    if args.roi is None and (args.dry_run or args.outputs != ['wells']):
+        archive = None
+        if 'archive' in args.outputs:
+            archive = ArchiveWriter(os.path.join(stitched_dir, ARCHIVE_FILE), args.archive_codec, args.output_format)
+        tasks = plan_outputs(wells, args.outputs, args, stitched_dir, geometry, archive)
+        if args.dry_run:
+            print_plan(tasks)
+            return
+    if args.roi is not None and args.dry_run:
+        print_roi_plan(wells, args, geometry)
+        return
+    # A dry run reads no pixels, so the plate intensity is only estimated for a real run
+    if args.rescale_intensity and args.intensity_sample is not None and wells:
+        args.plate_max_int = plate_intensity(plate_wells, args)
+    if wells:
         print('\nStitching wells...')
-        stitched_dir = os.path.join(args.path, 'stitched_wells')
-        dir_suffix = 1
-        while os.path.exists(stitched_dir):
-            dir_suffix += 1
-            stitched_dir = os.path.join(args.path, 'stitched_wells_' + str(dir_suffix))
         os.makedirs(stitched_dir)
         logging.info('Created directory ' + os.path.join(stitched_dir))
-        # Loop through only the well directories, the current directory does not need to be
-        # included as the files will already be sorted into subdirectories
-        dirs = [name for name in os.listdir(args.path) if os.path.isdir(name)]
-        well_dirs = [name for name in dirs if not name.startswith('stitched_wells')]
-        num_dirs = len(well_dirs)
-        for num, dir_name in enumerate(sorted(well_dirs, key=nat_key), start=1):
+    else:
+        logging.info('No images found\n')
+    if args.roi is not None:
+        for well_name, entries in wells:
+            img_layout = well_layout(entries, args.scan_direction, geometry)
+            offsets = None
+            if geometry is not None:
+                offsets = geometry.offsets(entries, args.scan_direction)
+            roi = extract_roi(entries, img_layout, args.roi, args, offsets)
+            save_well(roi, '{0}_roi_{1}_{2}_{3}_{4}'.format(well_name, *args.roi), args, stitched_dir)
+    elif args.outputs != ['wells']:
+        try:
+            run_plan(tasks, args.workers, args.memory_budget)
+        finally:
+            # The index is written even after a failure, so the finished wells can be read
+            if archive is not None:
+                archive.close()
+    elif args.workers > 1:
+        schedule_wells(wells, args, stitched_dir, geometry)
+    else:
+        num_wells = len(wells)
+        for num, (well_name, entries) in enumerate(wells, start=1):
             # Progress bar. The trailing space in the print function is needed to update that position.
             # Otherwise that would be forzen when moving from a two digit to a one digit number.
-            progress = int(num / num_dirs * 100)
-            print('{0}% {1} '.format(progress, dir_name), end='\r')
+            progress = int(num / num_wells * 100)
+            print('{0}% {1} '.format(progress, well_name), end='\r')
             sys.stdout.flush()
-
-            # add for channel here
-
-            imgs, zeroth_field, max_int = find_images(dir_name, input_format, args.flip, args.field_prefix)
-            # If there are images in the directory
-            if imgs:
-                if args.rescale_intensity:
-                    imgs = rescale_intensities(imgs, max_int)
-                fields, arr_dim, moves, starting_point = spiral_structure(dir_name, input_format, args.scan_direction)
-                img_layout = spiral_array(fields, arr_dim, moves, starting_point, zeroth_field)
-                stitched_well = stitch_images(imgs, img_layout, dir_name, output_format, arr_dim, stitched_dir)
-                stitched_well_name = os.path.join(stitched_dir, os.path.basename(dir_name) + '.' + output_format)
-                stitched_well.save(stitched_well_name, format=args.output_format)
-                logging.info('Stitched image saved to ' + stitched_well_name + '\n')
-            else:
-                logging.info('No images found in this directory\n')
-    else:
-        imgs, zeroth_field = find_images(args.path, input_format, args.flip, args.field_prefix, args.rescale_intensity)
-        stitched_dir = os.path.join(args.path, 'stitched_wells')
-        #if there are images in the directory
-        if imgs:
-            fields, arr_dim, moves, starting_point = spiral_structure(args.path, input_format, args.scan_direction)
-            img_layout = spiral_array(fields, arr_dim, moves, starting_point, zeroth_field)
-            stitched_name = stitch_images(imgs, img_layout, args.path, args.output_format, arr_dim)
-            logging.info('Stitched image saved to ' + stitched_name + '\n')
-        else:
-            logging.info('No images found\n')
+            img_layout = well_layout(entries, args.scan_direction, geometry)
+            mode, _ = choose_mode(entries, img_layout, args.memory_budget, args.threads)
+            stitch_well(well_name, entries, img_layout, args, stitched_dir, mode)
+    if geometry is not None:
+        geometry.save()
     #import time
     #time.sleep(2)
     #os.rename('./well_stitch.log', os.path.join(stitched_dir, 'well_stitch.log'))
 
     print('\n\nStitched well images can be found in ' + stitched_dir + '.\nPlease check the log file for which images and what field layout were used to create the stitched image.\nDone.')
 
-def rescale_intensities(imgs, max_int):
-    print(max_int)
-    for fnum, img in imgs.iteritems():
-        img_norm = np.array(img) - np.array(img).min()
-        img_norm = img_norm / (max_int / 256)
-        imgs[fnum] = Image.fromarray(np.uint8(img_norm))
-        print(img_norm.ravel().min(), img_norm.ravel().max())
-
-        #img_stretched = exposure.rescale_intensity(np.array(img), in_range=(0, max_int), out_range=('uint8'))
-        #print(img_stretched.ravel().min(), img_stretched.ravel().max())
-        #imgs[fnum] = Image.fromarray(np.uint8(img_stretched))
-    return imgs
-
-
-
-## Functions ##
-
-# Putting the main logic of the program into main() can actually make it run faster
-# this is since the local scopes are implememnted as arrays, which is faster then
-# the dictionary implementation of global scopes. More details:
-# http://stackoverflow.com/questions/11241523/why-does-python-code-run-faster-in-a-function
-def main():
-    # Set up the command line arguments
-    # the formatter_class adds the default value to optional arguments
-    # argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    # for positional arguments, one has to add the same string that the optional gets automatically
-    parser = argparse.ArgumentParser(description='A small utility for field images ' \
-        'exported from automated microscope platforms.\nStarts in the middle and ' \
-        'stitches fields in a spiral pattern to create the well image.\n' \
-        'Each well and channel need to be in a separate directory. Use `-c` to sort '\
-        'images into\ndirectories automatically. Make sure to specify the correct field '\
-        'and well string (-f, -w).\nExample usage when the images from all wells are in the '\
-        'same directory:\n\npython stitch_fields.py -cr -f <field_prefix> -w <well_prefix>',
-        formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('path', default=os.getcwd(), nargs='?',
-        help='path to images  (default: current directory)')
-    parser.add_argument('-o', '--output-format', nargs='?', default='jpeg',
-        help='format for the stitched image (default: %(default)s)')
-    parser.add_argument('-i', '--input-format', nargs='?', default='bmp',
-        help='format for images to be stitched, can also be a list of formats (default: %(default)s)')
-    parser.add_argument('-f', '--field-prefix', default='_f',
-        help='string immediately preceding the field number in the file name (default: %(default)s)')
-    parser.add_argument('-w', '--well-prefix', default='0001_',
-        help='string immediately preceding the well id in the file name (default: %(default)s)')
-    parser.add_argument('-d', '--scan-direction', nargs='?', default='left_down',
-        help='The directions from the 1st field to the 2nd and 3rd, e.g. left_down =\n' \
-        '9, 8, 7, \n' \
-        '2, 1, 6, \n' \
-        '3, 4, 5 (default: %(default)s)')
-    parser.add_argument('-e', '--sort-wells', action='store_true',
-        help='if all images are in the same directory, subfolders MUST be created. ' \
-        'Can be used to only sort files if -r is omitted')
-    parser.add_argument('-a', '--sort-channels', action='store_true',
-        help='Create subfolders for each channel based on the specified channel prefix.')
-    parser.add_argument('-r', '--recursive', action='store_true',
-        help='stitch images in subdirectories')
-    parser.add_argument('--flip', default='none', choices=['horizontal', 'vertical', 'both', 'none'], help='How to flip the image (default: %(default)s)')
-    #Initialize some variables
-    args = parser.parse_args()
-    # PIL's image function takes 'jpeg' instead of 'jpg' as an argument. We want to be able to
-    # specify the image format to this function while defining the image extensions as 'jpg'.
-    if args.output_format == 'jpeg':
-        output_format = 'jpg'
-    else:
-        output_format = args.output_format
-   # timestamp = str(int(time.time()))[3:]
-    input_format = set((args.input_format,)) #can add extra ext here is needed, remember to not have same as stiched
-    logging.basicConfig(filename='well_stitch.log',level=logging.DEBUG, format='%(message)s')
-    # Print out the runtime parameters and store them in a log file
-    for key in vars(args): # Returns a dictionary instead of a Namespace object
-        print(key +'\t', vars(args)[key])
-        #logging.info(key +'\t', vars(args)[key])
-
-    # Sort channels and create subfolders
-    if args.sort_channels:
-        print('\n Moving images to subfolders...')
-        channel_names = sort_channels(args.path, args,channel_prefix)
-
-    # Sort wells and create subfolders
-    if args.sort_wells:
-        print('\n Moving images to subfolders...')
-        well_names = sort_wells(args.path, args.well_prefix, input_format)
-
-    # Main program
-    if args.recursive:
-        # Create a new directory. Append a number if it already exists.
-        stitched_dir = os.path.join(args.path, 'stitched_wells')
-        dir_suffix = 1
-        while os.path.exists(stitched_dir):
-            dir_suffix += 1
-            stitched_dir = os.path.join(args.path, 'stitched_wells_' + str(dir_suffix))
-        os.makedirs(stitched_dir)
-        logging.info('Created directory ' + os.path.join(stitched_dir))
-        # Loop through only the well directories, the current directory does not need to be
-        # included as the files will already be sorted into subdirectories
-        dirs = [name for name in os.listdir(args.path) if os.path.isdir(name)]
-        well_dirs = [name for name in dirs if not name.startswith('stitched_wells')]
-        num_dirs = len(well_dirs)
-        for num, dir_name in enumerate(sorted(well_dirs, key=nat_key), start=1):
-            # Progress bar. The trailing space in the print function is needed to update that position.
-            # Otherwise that would be forzen when moving from a two digit to a one digit number.
-            progress = int(num / num_dirs * 100)
-            print('{0}% {1} '.format(progress, dir_name), end='\r')
-            sys.stdout.flush()
-            imgs, zeroth_field = find_images(dir_name, input_format, args.flip, args.field_prefix)
-            # If there are images in the directory
-            if imgs:
-                fields, arr_dim, moves, starting_point = spiral_structure(dir_name, input_format, args.scan_direction)
-                img_layout = spiral_array(fields, arr_dim, moves, starting_point, zeroth_field)
-                stitched_well = stitch_images(imgs, img_layout, dir_name, args.output_format, arr_dim, stitched_dir)
-                stitched_well_name = os.path.join(stitched_dir, os.path.basename(dir_name) + '.' + output_format)
-                stitched_well.save(stitched_well_name, format=args.output_format)
-                logging.info('Stitched image saved to ' + stitched_well_name + '\n')
-            else:
-                logging.info('No images found in this directory\n')
-    else:
-        imgs, zeroth_field = find_images(args.path, input_format, args.flip, args.field_prefix)
-        stitched_dir = os.path.join(args.path, 'stitched_wells')
-        #if there are images in the directory
-        if imgs:
-            fields, arr_dim, moves, starting_point = spiral_structure(args.path, input_format, args.scan_direction)
-            img_layout = spiral_array(fields, arr_dim, moves, starting_point, zeroth_field)
-            stitched_name = stitch_images(imgs, img_layout, args.path, args.output_format, arr_dim)
-            logging.info('Stitched image saved to ' + stitched_name + '\n')
-        else:
-            logging.info('No images found\n')
-
-    os.rename('./well_stitch.log', os.path.join(stitched_dir, 'well_stitch.log'))
-
-    print('\n\nStitched well images can be found in ' + stitched_dir + '.\nPlease check the log file for which images and what field layout were used to create the stitched image.\nDone.')
-
+# Rows of a field that are rescaled at a time, the float temporaries are only this large
+TRANSFORM_BAND_ROWS = 64
 
 
+def rescale_field(field, max_int, out=None, offset=None):
+    '''
+    Stretch a field to 8 bits, its minimum (or `offset`) becomes 0 and max_int 256 and
+    anything brighter is clipped. The offset, scale, clip and conversion are done a band of
+    rows at a time straight into `out`, e.g. the slot of the field in the canvas, so there
+    is no temporary the size of the field. The field can be a flipped view.
+    '''
+    if out is None:
+        out = np.empty(field.shape, dtype=np.uint8)
+    if offset is None:
+        offset = field.min()
+    scale = max_int / 256
+    band = np.empty((min(TRANSFORM_BAND_ROWS, field.shape[0]),) + field.shape[1:], dtype=np.float64)
+    for start in range(0, field.shape[0], TRANSFORM_BAND_ROWS):
+        stop = min(start + TRANSFORM_BAND_ROWS, field.shape[0])
+        rows = band[:stop - start]
+        np.subtract(field[start:stop], offset, out=rows)
+        np.true_divide(rows, scale, out=rows)
+        np.clip(rows, 0, 255, out=rows)
+        out[start:stop] = rows
+    return out
 
 
 
+## Functions ##
 
 # Define movement function for filling in the spiral array
 def move_right(x,y):
@@ -306,12 +342,10 @@ def move_up(x,y):
     return x -1,y
 
 
-def spiral_structure(dir_path, input_format, scan_direction):
+def spiral_structure(fields, scan_direction):
     '''
     Define the movement scheme and starting point for the field layout
     '''
-    #find the number of fields/images matching the specified extension(s)
-    fields = len([fname for fname in os.listdir(dir_path) if fname[-3:].lower() in input_format])
     #size the array based on the field number, array will be squared
     arr_dim = int(np.ceil(np.sqrt(fields)))
     #define the movement schema and find the starting point (middle) of the array
@@ -399,93 +433,670 @@ def spiral_array(fields, arr_dim, moves, starting_point, zeroth_field):
     img_layout = np.zeros((arr_dim, arr_dim), dtype=int)
     img_layout[:] = -1 #TODO this means that the zeroth field will be put in multiple places... fixed?
     #create a different layout depending on the numbering of the first field
-    if zeroth_field:
-        for point, coord in list(gen_points(fields, moves, starting_point)):
-            img_layout[coord] = point -1
-        logging.info('\nField layout:')
-        for row in np.ma.masked_equal(img_layout, -1): #TODO fix so that lines are showing for unused field
-            logging.info(' '.join(['{:>2}'.format(str(i)) for i in row]))
-
-    else:
-        for point, coord in list(gen_points(fields, moves, starting_point)):
-            img_layout[coord] = point
-        logging.info('Field layout:')
-        for row in np.ma.masked_equal(img_layout, -1):
-            logging.info(' '.join(['{:>2}'.format(str(i)) for i in row]))
+    for point, coord in gen_points(fields, moves, starting_point):
+        img_layout[coord] = point - 1 if zeroth_field else point
+    # Crop to the bounding box of the occupied positions. A partial spiral, e.g. 10 fields in
+    # a 4x4 array, would otherwise leave whole rows and columns of black canvas behind.
+    rows, cols = np.nonzero(img_layout >= 0)
+    img_layout = img_layout[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
+    log_layout(img_layout)
 
     return img_layout
 
 
-def find_images(dir_path, input_format, flip, field_str):
+def log_layout(img_layout, header='Field layout:'):
+    logging.info('\n' + header)
+    for row in np.ma.masked_equal(img_layout, -1):
+        logging.info(' '.join(['{:>2}'.format(str(i)) for i in row]))
+
+
+# Conversions allowed in a file name template. `{well:A01}` is the row letter(s) followed by the
+# column number, `{field:d}` is any integer and a token without a conversion matches as few
+# characters as possible.
+TEMPLATE_CONVERSIONS = {
+    '': r'.*?',
+    'd': r'\d+',
+    'A01': r'[A-Za-z]+\d+',
+}
+TEMPLATE_TOKEN = re.compile(r'\{(\w+)(?::([^}]*))?\}')
+
+NameTemplate = namedtuple('NameTemplate', ['template', 'regex', 'int_tokens'])
+FieldEntry = namedtuple('FieldEntry', ['path', 'well', 'field', 'channel', 'z', 't'])
+
+
+def compile_template(template):
+    '''
+    Compile a file name template such as `{plate}_{well:A01}f{field:d}d{channel:d}.{ext}`
+    into a single regular expression with one named group per token
+    '''
+    pattern = []
+    int_tokens = []
+    pos = 0
+    for token in TEMPLATE_TOKEN.finditer(template):
+        name, conversion = token.group(1), token.group(2) or ''
+        if conversion not in TEMPLATE_CONVERSIONS:
+            raise ValueError('Unknown conversion "{0}" for {{{1}}} in the name template'.format(conversion, name))
+        pattern.append(re.escape(template[pos:token.start()]))
+        pattern.append('(?P<{0}>{1})'.format(name, TEMPLATE_CONVERSIONS[conversion]))
+        if conversion == 'd':
+            int_tokens.append(name)
+        pos = token.end()
+    pattern.append(re.escape(template[pos:]))
+    regex = re.compile(''.join(pattern) + '$')
+    if 'field' not in regex.groupindex:
+        raise ValueError('The name template needs a {field:d} token: ' + template)
+    return NameTemplate(template, regex, tuple(int_tokens))
+
+
+def scan_fields(dir_path, name_template, input_format):
+    '''
+    Parse a whole directory listing into a table of field entries (path, well, field, channel).
+    Files without one of the input extensions or not matching the template are skipped.
+    '''
+    match = name_template.regex.match
+    int_tokens = name_template.int_tokens
+    table = []
+    for path in list_fields(dir_path):
+        fname = os.path.basename(path)
+        if fname[-3:].lower() not in input_format:
+            continue
+        parsed = match(fname)
+        if parsed is None:
+            logging.info('Skipping ' + fname + ', it does not match ' + name_template.template)
+            continue
+        tokens = parsed.groupdict()
+        for name in int_tokens:
+            tokens[name] = int(tokens[name])
+        table.append(FieldEntry(path, tokens.get('well'),
+            tokens['field'], tokens.get('channel'), tokens.get('z'), tokens.get('t')))
+    table.sort(key=entry_key)
+    return table
+
+
+# Separates a zip or tar file from the member in the path of a field that is read straight
+# from a plate archive, e.g. plate.zip!/A01/MFGTMP_A01f00d0.bmp
+MEMBER_SEPARATOR = '!/'
+# Members of the plate archives listed so far, the zip handles of each thread and the open
+# compressed tar streams, all per process
+_plate_members = {}
+_plate_handles = threading.local()
+_plate_streams = {}
+_plate_lock = threading.Lock()
+
+
+def is_plate_archive(path):
+    '''
+    Whether the plate source is a zip or tar file instead of a directory
+    '''
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def split_member(path):
+    '''
+    Split a field path into the plate archive and the member name, (None, path) for files
+    '''
+    if MEMBER_SEPARATOR not in path:
+        return None, path
+    return tuple(path.split(MEMBER_SEPARATOR, 1))
+
+
+def plate_members(archive):
+    '''
+    List the files in a zip or tar file in one pass over its directory or headers. Returns
+    the kind of archive, 'zip', 'tar' or 'tar stream' for compressed tar files, and an
+    ordered dict of member name -> ZipInfo or TarInfo.
+    '''
+    with _plate_lock:
+        if archive not in _plate_members:
+            if zipfile.is_zipfile(archive):
+                with zipfile.ZipFile(archive) as zf:
+                    members = [(info.filename, info) for info in zf.infolist() if not info.filename.endswith('/')]
+                kind = 'zip'
+            else:
+                with tarfile.open(archive) as tf:
+                    members = []
+                    try:
+                        for info in tf:
+                            if info.isfile():
+                                members.append((info.name, info))
+                    except (tarfile.TarError, zlib.error, EOFError) as error:
+                        # The members before the damage can still be read
+                        logging.info('{0} is damaged after {1} members ({2})'.format(archive, len(members), error))
+                    kind = 'tar' if tf.fileobj.__class__ is io.BufferedReader else 'tar stream'
+            _plate_members[archive] = (kind, OrderedDict(members))
+        return _plate_members[archive]
+
+
+def list_fields(dir_path):
+    '''
+    Paths of the files in a directory. A plate archive stands for all the files in it, and
+    a directory inside one (plate.zip!/A01) for the files directly in that directory.
+    '''
+    archive, prefix = split_member(dir_path)
+    if archive is None:
+        if not is_plate_archive(dir_path):
+            return [os.path.join(dir_path, fname) for fname in os.listdir(dir_path)]
+        archive, prefix = dir_path, None
+    kind, members = plate_members(archive)
+    if prefix is None:
+        return [archive + MEMBER_SEPARATOR + name for name in members]
+    prefix = prefix.rstrip('/') + '/'
+    return [archive + MEMBER_SEPARATOR + name for name in members
+        if name.startswith(prefix) and '/' not in name[len(prefix):]]
+
+
+def field_location(path):
+    '''
+    Where the bytes of a field lie in one piece on disk: (file, start, size). None for
+    members that are compressed in their archive.
+    '''
+    archive, member = split_member(path)
+    if archive is None:
+        return path, 0, os.path.getsize(path)
+    kind, members = plate_members(archive)
+    info = members[member]
+    if kind == 'tar':
+        return (archive, info.offset_data, info.size) if not info.issparse() else None
+    if kind == 'zip' and info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 1:
+        # The data follows the local header, whose name and extra field can differ from the
+        # central directory
+        with open(archive, 'rb') as f:
+            f.seek(info.header_offset)
+            header = f.read(30)
+        name_bytes, extra_bytes = struct.unpack('<HH', header[26:30])
+        return archive, info.header_offset + 30 + name_bytes + extra_bytes, info.file_size
+    return None
+
+
+def field_size(path):
+    '''
+    Size in bytes of a field file or of the uncompressed archive member
+    '''
+    archive, member = split_member(path)
+    if archive is None:
+        return os.path.getsize(path)
+    info = plate_members(archive)[1][member]
+    return info.file_size if isinstance(info, zipfile.ZipInfo) else info.size
+
+
+def open_field(path):
+    '''
+    Open a field for reading, also when it is a member of a plate archive. Members stored
+    uncompressed are read in place. Compressed zip members are decompressed through a zip
+    handle of the calling thread, so threads read in parallel, while compressed tar files
+    are a single stream that is read under a lock. Nothing is extracted to disk. A damaged
+    member raises IOError like an unreadable file.
+    '''
+    location = field_location(path)
+    if location is not None:
+        return FileWindow(*location) if location[0] != path else open(path, 'rb')
+    archive, member = split_member(path)
+    try:
+        return io.BytesIO(read_member(archive, member))
+    except (zipfile.BadZipfile, zlib.error, tarfile.TarError, EOFError) as error:
+        raise IOError('{0} cannot be read from {1} ({2})'.format(member, archive, error))
+
+
+def read_member(archive, member):
+    '''
+    The bytes of a compressed member of a plate archive
+    '''
+    kind, members = plate_members(archive)
+    if kind == 'zip':
+        # Handles are per process too, a forked worker must not share the file position
+        if getattr(_plate_handles, 'pid', None) != os.getpid():
+            _plate_handles.pid = os.getpid()
+            _plate_handles.archives = {}
+        if archive not in _plate_handles.archives:
+            _plate_handles.archives[archive] = zipfile.ZipFile(archive)
+        return _plate_handles.archives[archive].read(members[member])
+    with _plate_lock:
+        pid, stream = _plate_streams.get(archive, (None, None))
+        if pid != os.getpid():
+            stream = TarStream(archive, members)
+            _plate_streams[archive] = (os.getpid(), stream)
+        return stream.read(members[member])
+
+
+def archive_order(path):
+    '''
+    Sort key that puts the members of a plate archive in the order they are stored in it
+    '''
+    archive, member = split_member(path)
+    if archive is None:
+        return path, 0
+    info = plate_members(archive)[1][member]
+    return archive, info.header_offset if isinstance(info, zipfile.ZipInfo) else info.offset_data
+
+
+# Members of a compressed tar file that were read or passed over on the way to a later one
+# are kept, the least recently used go first beyond this many bytes
+TAR_STREAM_BUFFER = 64 * 2**20
+
+
+class TarStream(object):
+    '''
+    A compressed tar file read front to back. Going back to an earlier member decompresses
+    the archive from the start again, so the members read lately and those passed over on
+    the way to a later one are kept. Fields read a little out of archive order, by threads,
+    by a header read before the pixels, or by the channels of a well one after the other,
+    then cost a single pass.
+    '''
+    def __init__(self, archive, members):
+        self.archive = archive
+        self.tf = tarfile.open(archive)
+        self.order = sorted(members.values(), key=lambda info: info.offset_data)
+        self.starts = [info.offset_data for info in self.order]
+        self.position = 0
+        self.kept = OrderedDict()
+        self.kept_bytes = 0
+
+    def read(self, info):
+        data = self.kept.pop(info.name, None)
+        if data is not None:
+            self.kept_bytes -= len(data)
+        else:
+            if info.offset_data < self.position:
+                logging.info('Decompressing {0} from the start again for {1}'.format(self.archive, info.name))
+            else:
+                for other in self.order[bisect_left(self.starts, self.position):
+                        bisect_left(self.starts, info.offset_data)]:
+                    if other.name not in self.kept:
+                        self.keep(other.name, self.tf.extractfile(other).read())
+            data = self.tf.extractfile(info).read()
+            self.position = info.offset_data + info.size
+        self.keep(info.name, data)
+        return data
+
+    def keep(self, name, data):
+        self.kept[name] = data
+        self.kept_bytes += len(data)
+        while self.kept_bytes > TAR_STREAM_BUFFER:
+            name, data = self.kept.popitem(last=False)
+            self.kept_bytes -= len(data)
+
+
+class FileWindow(object):
     '''
-    Create a dictionary with the field numbers as keys to the field images
+    Read-only file object over a byte range of a larger file, so a member stored in an
+    archive reads like a file of its own
+    '''
+    def __init__(self, path, start, size):
+        self.f = open(path, 'rb')
+        self.start = start
+        self.size = size
+        self.f.seek(start)
+
+    def read(self, size=-1):
+        remaining = max(self.size - self.tell(), 0)
+        return self.f.read(remaining if size is None or size < 0 else min(size, remaining))
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.f.seek(self.start + offset)
+        return offset
+
+    def tell(self):
+        return self.f.tell() - self.start
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def entry_key(entry):
+    '''
+    Sort field entries naturally by well, then channel, field number, z-plane and timepoint.
+    '''
+    return nat_key(entry.well or ''), none_first(entry.channel), entry.field, none_first(entry.t), none_first(entry.z)
+
+
+def none_first(value):
+    return -1 if value is None else value
+
+
+def group_fields(table, projected=()):
+    '''
+    Split a field table into one list of entries per (well, channel, z, t), in natural order.
+    The dimensions in `projected` are left out of the key, so their planes end up in the
+    same group to be projected.
+    '''
+    groups = OrderedDict()
+    for entry in table:
+        key = (entry.well, entry.channel, None if 'z' in projected else entry.z,
+            None if 't' in projected else entry.t)
+        groups.setdefault(key, []).append(entry)
+    return groups
+
+
+def group_name(key, channel_prefix):
+    '''
+    Name used for the stitched image and the subfolder of a (well, channel, z, t) group
+    '''
+    well, channel, z, t = key
+    parts = []
+    if well is not None:
+        parts.append(well)
+    if channel is not None:
+        parts.append(channel_prefix + str(channel))
+    if t is not None:
+        parts.append('t' + str(t))
+    if z is not None:
+        parts.append('z' + str(z))
+    return '_'.join(parts) or 'well'
+
+
+def find_images(entries, flip, projection='max', max_int=None, rescale=True):
+    '''
+    Create a dictionary with the field numbers as keys to the field images. Fields with
+    several z-planes or timepoints are projected as they are read. If the plate max
+    intensity is already known it is passed through instead of computed from the well,
+    without rescaling it is not computed at all.
     '''
     zeroth_field = False #changes if a zeroth field is found in 'find_images'
     imgs = {}
     max_ints = []
     logging.info('----------------------------------------------')
-    logging.info(dir_path)
-    #go through each directory
-    for fname in os.listdir(dir_path):
-        if fname[-3:].lower() in input_format:
-            logging.info(fname)
-            #find the index of the field identifier string in the file name
-            field_ind = fname.index(field_str) + len(field_str)
-            fnum = int(''.join([str(int(char)) for char in fname[field_ind:field_ind+2] if char.isdigit()]))
-            # If field 0 is encountered, change start numbering of the array
-            if fnum == 0:
-                zeroth_field = True
-            # The default is to flip horizontally since this is the most common case
-            if flip == 'none':
-                imgs[fnum] = Image.open(os.path.join(dir_path, fname))
-            elif flip == 'horizontal':
-                imgs[fnum] = Image.open(os.path.join(dir_path, fname)).transpose(Image.FLIP_LEFT_RIGHT)
-            elif flip == 'vertical':
-                # dunno why we need to flip...
-                imgs[fnum] = Image.open(os.path.join(dir_path, fname)).transpose(Image.FLIP_TOP_BOTTOM)
-            elif flip == 'both':
-                # I don't think thei sould ever be the case, it could just be adjusted with another
-                # spiral rotation, but putting it here for completion
-                imgs[fnum] = Image.open(os.path.join(dir_path, fname)).transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
-            # Collect max intensities here instead of looping through an extra time
-            max_ints.append(np.percentile(np.array(imgs[fnum]).ravel(), 99.999)) # make this a user variable
-         #   min_ints.append(np.percentile(np.array(imgs[fnum]).ravel(), 0.11)) # make this a user variable
-#            if rescale_intensity:
-#               img_stretched = exposure.rescale_intensity(np.array(imgs[fnum]), in_range='uint12', out_range=('uint8'))
-#               imgs[fnum] = Image.fromarray(np.uint8(img_stretched))
+    logging.info(os.path.dirname(entries[0].path))
+    #go through each field of the well
+    for fnum, planes in groupby(entries, key=lambda entry: entry.field):
+        planes = list(planes)
+        for entry in planes:
+            logging.info(os.path.basename(entry.path))
+        # If field 0 is encountered, change start numbering of the array
+        if fnum == 0:
+            zeroth_field = True
+        imgs[fnum] = project_field(planes, flip, projection)
+        if max_int is not None or not rescale:
+            continue
+        # Collect max intensities here instead of looping through an extra time
+        max_ints.append(np.percentile(imgs[fnum], FIELD_PERCENTILE))
+    if max_int is not None or not rescale:
+        return imgs, zeroth_field, max_int
     print(max_ints)
     if max_ints != []:
        # max_ints = max(max_ints) # the highest intensity in the entire plate
-        max_ints = np.percentile(np.array(max_ints), 70) # the highest intensity in the entire plate
+        max_ints = np.percentile(np.array(max_ints), PLATE_PERCENTILE) # the highest intensity in the entire plate
         print(max_ints)
     return imgs, zeroth_field, max_ints
 
 
+def project_field(planes, flip, projection):
+    '''
+    Read the planes of one field and reduce them to a max or mean intensity projection as a
+    running reduction, so only the accumulator and the plane being read are held
+    '''
+    field = read_field(planes[0].path, flip)
+    if len(planes) == 1:
+        return field
+    dtype = field.dtype
+    if projection == 'mean':
+        projected = field.astype(np.float64)
+    else:
+        projected = np.array(field)
+    for plane in planes[1:]:
+        field = read_field(plane.path, flip)
+        if projection == 'mean':
+            projected += field
+        else:
+            np.maximum(projected, field, out=projected)
+    if projection == 'mean':
+        projected /= len(planes)
+        projected = np.rint(projected, out=projected).astype(dtype)
+    return projected
+
 
+def read_field(path, flip):
+    '''
+    Read a field into a numpy array and flip it as requested. The pixels of uncompressed BMP
+    and TIFF files are read in one go without PIL and flipped with negative strides, so
+    they are not copied after reading.
+    '''
+    field = read_raw_field(path)
+    if field is None and _field_cache is not None:
+        field = _field_cache.load(path)
+    if field is None:
+        img = Image.open(open_field(path))
+        if img.mode == 'P':
+            img = img.convert('RGB')
+        field = np.asarray(img)
+        if _field_cache is not None:
+            _field_cache.store(path, field)
+    # The default is to flip horizontally since this is the most common case
+    if flip == 'horizontal':
+        field = field[:, ::-1]
+    elif flip == 'vertical':
+        # dunno why we need to flip...
+        field = field[::-1]
+    elif flip == 'both':
+        # I don't think thei sould ever be the case, it could just be adjusted with another
+        # spiral rotation, but putting it here for completion
+        field = field[::-1, ::-1]
+    return field
+
+
+def read_raw_field(path):
+    '''
+    Read the pixels of an uncompressed BMP or TIFF file straight into an array oriented top
+    to bottom. Files stored uncompressed in a plate archive are read in place. Returns None
+    for any other file, those are decoded by PIL instead. The file is closed again, a
+    memory map per field would hold a file descriptor for every field of a well.
+    '''
+    location = field_location(path)
+    if location is None:
+        return None
+    source, start, size = location
+    with FileWindow(source, start, size) as f:
+        magic = f.read(4)
+        f.seek(0)
+        try:
+            if magic[:2] == b'BM':
+                layout = bmp_layout(f)
+            elif magic in (b'II*\x00', b'MM\x00*'):
+                layout = tiff_layout(f)
+            else:
+                layout = None
+        except (KeyError, IndexError, struct.error):
+            layout = None
+    if layout is None:
+        return None
+    offset, dtype, shape, row_bytes, bottom_up, bgr = layout
+    if offset + shape[0] * row_bytes > size:
+        # The file is shorter than its header says, let PIL report it
+        return None
+    with open(source, 'rb') as f:
+        f.seek(start + offset)
+        raw = np.fromfile(f, dtype=np.uint8, count=shape[0] * row_bytes)
+    if raw.size < shape[0] * row_bytes:
+        # The file is shorter than its header says, let PIL report it
+        return None
+    strides = (row_bytes, dtype.itemsize * shape[2], dtype.itemsize) if len(shape) == 3 else (row_bytes, dtype.itemsize)
+    field = np.ndarray(shape, dtype=dtype, buffer=raw, strides=strides)
+    if bottom_up:
+        field = field[::-1]
+    if bgr:
+        field = field[..., ::-1]
+    return field
+
+
+def bmp_layout(f):
+    '''
+    Read the headers of an uncompressed 8-bit greyscale or 24-bit BMP file. Returns the
+    pixel offset, dtype, shape, padded row size, whether rows are stored bottom-up and
+    whether the channels are in BGR order.
+    '''
+    header = bmp_header(f)
+    if header is None:
+        return None
+    offset, dib_size, width, height, bits, compression, colors = header
+    if compression != 0 or bits not in (8, 24):
+        return None
+    if bits == 8:
+        # Only a grey palette maps to the pixel values as they are stored
+        colors = colors or 256
+        entry_size = 3 if dib_size == 12 else 4
+        f.seek(14 + dib_size)
+        palette = np.frombuffer(f.read(colors * entry_size), dtype=np.uint8)
+        if palette.size != colors * entry_size:
+            return None
+        if not (palette.reshape(colors, entry_size)[:, :3] == np.arange(colors)[:, None]).all():
+            return None
+        shape = (abs(height), width)
+    else:
+        shape = (abs(height), width, 3)
+    # Rows are padded to a multiple of 4 bytes
+    row_bytes = (width * bits // 8 + 3) & ~3
+    return offset, np.dtype(np.uint8), shape, row_bytes, height > 0, bits == 24
 
-    return imgs, zeroth_field
 
-#stitch the image row by row
-def stitch_images(imgs, img_layout, dir_path, output_format, arr_dim, stiched_dir):
+def bmp_header(f):
     '''
-    Stitch images by going row and column wise in the img_layout and look up
-    the number of the image to place at the (row, col) coordinate. So not filling
-    in a spiral but using the spiral lookuptable instead.
+    Read the file and DIB headers of a BMP file. Returns the pixel offset, DIB header size,
+    width, height, bits per pixel, compression and palette size, or None for DIB headers
+    other than the OS/2 and Windows ones.
     '''
-    # Create the size of the well image to be filled in
-    width, height = imgs[1].size
-    num = 0
-    stitched_well = Image.new('RGB', (width*arr_dim, height*arr_dim))
-    for row in xrange(0, width*arr_dim, width):
-        for col in xrange(0, height*arr_dim, height):
-            #since the image is filled by row and col instead of sprial, this
-            #error catching is needed for the empty places
-            try:
-                #'stitch' fields by pasting them at the appropriate place in the black background
-                stitched_well.paste(imgs[img_layout.ravel()[num]], (col, row))
-            except KeyError:
-                pass
-            num += 1
+    header = f.read(54)
+    offset, dib_size = struct.unpack('<II', header[10:18])
+    if dib_size == 12:
+        width, height, planes, bits = struct.unpack('<HHHH', header[18:26])
+        compression, colors = 0, 0
+    elif dib_size >= 40:
+        width, height, planes, bits, compression = struct.unpack('<iiHHI', header[18:34])
+        colors = struct.unpack('<I', header[46:50])[0]
+    else:
+        return None
+    return offset, dib_size, width, height, bits, compression, colors
+
+
+# TIFF field types that can hold the tags we need, SHORT and LONG
+TIFF_TYPES = {3: 'H', 4: 'I'}
+
+
+def tiff_layout(f):
+    '''
+    Read the first IFD of an uncompressed, single-plane TIFF file whose strips follow each
+    other. Returns the same layout tuple as bmp_layout.
+    '''
+    endian, tags = tiff_tags(f)
+    width, height = tags[256][0], tags[257][0]
+    bits = set(tags.get(258, (1,)))
+    samples = tags.get(277, (1,))[0]
+    # No compression, contiguous planes, BlackIsZero or RGB, and no tiles
+    if tags.get(259, (1,))[0] != 1 or tags.get(284, (1,))[0] != 1 or \
+            tags.get(262, (1,))[0] not in (1, 2) or 322 in tags:
+        return None
+    kind = {1: 'u', 2: 'i', 3: 'f'}.get(tags.get(339, (1,))[0])
+    if len(bits) != 1 or kind is None or bits.pop() not in (8, 16, 32):
+        return None
+    offsets, byte_counts = tags[273], tags[279]
+    if any(offsets[i] + byte_counts[i] != offsets[i+1] for i in range(len(offsets) - 1)):
+        return None
+    dtype = np.dtype(endian + kind + str(tags[258][0] // 8))
+    if kind == 'f' and dtype.itemsize != 4:
+        return None
+    shape = (height, width) if samples == 1 else (height, width, samples)
+    return offsets[0], dtype, shape, width * samples * dtype.itemsize, False, False
+
+
+def tiff_tags(f):
+    '''
+    Read the SHORT and LONG tags of the first IFD of a TIFF file. Returns the byte order
+    prefix and a dict of tag -> tuple of values.
+    '''
+    endian = '<' if f.read(2) == b'II' else '>'
+    magic, ifd_offset = struct.unpack(endian + 'HI', f.read(6))
+    f.seek(ifd_offset)
+    num_tags = struct.unpack(endian + 'H', f.read(2))[0]
+    ifd = f.read(12 * num_tags)
+    tags = {}
+    for pos in range(0, 12 * num_tags, 12):
+        tag, kind, count = struct.unpack(endian + 'HHI', ifd[pos:pos+8])
+        if kind not in TIFF_TYPES:
+            continue
+        fmt = endian + TIFF_TYPES[kind] * count
+        value = ifd[pos+8:pos+12]
+        # Values that do not fit in the entry are stored elsewhere in the file
+        if struct.calcsize(fmt) > 4:
+            f.seek(struct.unpack(endian + 'I', value)[0])
+            value = f.read(struct.calcsize(fmt))
+        tags[tag] = struct.unpack(fmt, value[:struct.calcsize(fmt)])
+    return endian, tags
+
+
+def well_layout(entries, scan_direction, geometry=None):
+    '''
+    Work out the field layout of a well from its field table, without decoding any image.
+    With a GeometryCache, a layout stored by an earlier timepoint or run is reused.
+    '''
+    if geometry is not None:
+        return geometry.layout(entries, scan_direction)
+    fnums = set(entry.field for entry in entries)
+    return field_layout(layout_size(fnums), 0 in fnums, scan_direction)
+
+
+def layout_size(fnums):
+    '''
+    Number of spiral positions a well needs. This goes up to the highest field number, so a
+    gap in the numbering leaves an empty place instead of pushing the last fields out.
+    '''
+    return max(fnums) + 1 if 0 in fnums else max(fnums)
+
+
+def field_layout(fields, zeroth_field, scan_direction):
+    '''
+    The cropped spiral layout for a number of fields
+    '''
+    fields, arr_dim, moves, starting_point = spiral_structure(fields, scan_direction)
+    return spiral_array(fields, arr_dim, moves, starting_point, zeroth_field)
+
+
+def log_unplaced(fnums, img_layout):
+    '''
+    Log the fields that have no place in the layout, returns the set of them. They are
+    left out of the well.
+    '''
+    unplaced = set(fnums) - set(img_layout[img_layout >= 0].tolist())
+    for fnum in sorted(unplaced):
+        logging.info('Field {0} has no place in the field layout, leaving it out'.format(fnum))
+    return unplaced
+
+
+#stitch the image block by block
+def stitch_images(imgs, img_layout, dir_path, output_format, stiched_dir, out=None, fill=0, max_int=None):
+    '''
+    Stitch images by viewing the canvas as a (rows, cols, height, width) array of field
+    slots and copying each field into the slot the spiral lookuptable gives it. Empty
+    and missing slots get the fill value in one go. The canvas can be passed in as `out`,
+    e.g. a shared memory block. With max_int, the fields are rescaled to 8 bits on the way
+    into their slots.
+    '''
+    rows, cols = img_layout.shape
+    # Create the size of the well image to be filled in, the layout is already cropped
+    # to the occupied fields so the canvas is only as large as it needs to be. The field
+    # size is the one most fields have, the others are fitted into their slot.
+    shapes = Counter(field.shape for field in imgs.values())
+    shape = shapes.most_common(1)[0][0]
+    if out is None:
+        dtype = np.result_type(*[field.dtype for field in imgs.values()]) if max_int is None else np.uint8
+        stitched_well = np.empty((shape[0]*rows, shape[1]*cols) + shape[2:], dtype=dtype)
+    else:
+        stitched_well = out
+    blocks = canvas_blocks(stitched_well, rows, cols)
+    present = np.isin(img_layout, list(imgs))
+    for fnum in img_layout[(img_layout >= 0) & ~present]:
+        logging.info('Field {0} is missing, leaving its place empty'.format(fnum))
+    log_unplaced(imgs, img_layout)
+    blocks[~present] = fill
+    for row, col in zip(*np.nonzero(present)):
+        place_field(blocks, row, col, imgs[img_layout[row, col]], img_layout[row, col], fill, max_int)
     #save image
 #    stitched_name = os.path.join(dir_path, 'stitched_wells/stitched_' + timestamp + '.' + output_format)
 #    stitched.save(stitched_name, format=output_format)
@@ -494,94 +1105,1315 @@ def stitch_images(imgs, img_layout, dir_path, output_format, arr_dim, stiched_di
     return stitched_well
 
 
-def sort_channels(dir_path, channel_str, input_format):
-    well_names = []
-    num = 0
-    for fname in os.listdir(dir_path):
-        if fname[-3:].lower() in input_format:
-            well_ind = fname.index(channel_str) + len(channel_str)
-            well_name = [fname[well_ind]]
-def sort_wells(dir_path, well_str, input_format):
-    well_names = []
-    num = 0
-    #go through all the files to find the well names
-    for fname in os.listdir(dir_path):
-        if fname[-3:].lower() in input_format:
-            #find the well id using the provided helper string and add it to the list
-            well_ind = fname.index(well_str) + len(well_str)
-            well_name = [fname[well_ind]]
-            well_name.append([str(int(char)) for char in fname[well_ind+1:well_ind+3] if char.isdigit()])
-            well_name = ''.join([char for sublist in well_name for char in sublist])
-            well_names.append(well_name)
-            #if the well name is not the same as the previous or if it is the first
-            #file, make a new directory
-            if well_name != well_names[num-1] or num == 0:
-                num += 1
-                if not os.path.exists(os.path.join(dir_path, well_name)):
-                    os.makedirs(os.path.join(dir_path, well_name))
-            logging.info('moving ./' + fname + ' to ./' + os.path.join(well_name, fname))
-            shutil.move(os.path.join(dir_path, fname), os.path.join(os.path.join(dir_path, well_name), fname))
-    logging.info('created well directories ' + str(set(well_names)))
+def canvas_blocks(canvas, rows, cols):
+    '''
+    View a (rows*height, cols*width[, channels]) canvas as a (rows, cols, height, width
+    [, channels]) array of field slots, without copying it
+    '''
+    height, width = canvas.shape[0] // rows, canvas.shape[1] // cols
+    return canvas.reshape((rows, height, cols, width) + canvas.shape[2:]).swapaxes(1, 2)
 
-    return set(well_names)
 
-def sort_wells(dir_path, well_str, input_format, channel_names):
-    well_names = []
-    num = 0
-#    for channel_name in channel_names:
-#        print('cahnnel name = ' + channel_name)
-#       channel_path = os.path.join(dir_path, channel_name)
-        #go through all the files to find the well names
-    for fname in os.listdir(dir_path):
-        print(fname)
-        if fname[-3:].lower() in input_format:
-            #find the well id using the provided helper string and add it to the list
-            well_ind = fname.index(well_str) + len(well_str)
-            well_name = [fname[well_ind]]
-            well_name.append([str(int(char)) for char in fname[well_ind+1:well_ind+3] if char.isdigit()])
-            well_name = ''.join([char for sublist in well_name for char in sublist])
-            well_names.append(well_name)
-            #if the well name is not the same as the previous or if it is the first
-            #file, make a new directory
-            if well_name != well_names[num-1] or num == 0:
-                num += 1
-                if not os.path.exists(os.path.join(dir_path, well_name)):
-                    os.makedirs(os.path.join(dir_path, well_name))
-            #move the current file to the new directory
-            logging.info('moving ./' + fname + ' to ./' + os.path.join(well_name, fname))
-            shutil.move(os.path.join(dir_path, fname), os.path.join(os.path.join(dir_path, well_name), fname))
-            logging.info('created well directories ' + str(set(well_names)))
-        #Create a dir for each well and move all the matching files to it
-    #    for well_name in set(well_names):
-    #        if not os.path.exists(os.path.join(dir_path, well_name)):
-    #            os.makedirs(os.path.join(dir_path, well_name))
-    #            for fname in os.listdir(dir_path):
-    #                if fname[-3:] in input_format:
-    #                    well_ind = fname.index(well_str) + len(well_str)
-    #                    if well_name == ''.join([str(int(char)) for char in fname[well_ind:well_ind+2] if char.isdigit()]):
-    #                        shutil.move(os.path.join(dir_path, fname), os.path.join(os.path.join(dir_path, well_name), fname))
-    #
-            #move the current file to the new directory
-            logging.info('moving ./' + fname + ' to ./' + os.path.join(well_name, fname))
-            shutil.move(os.path.join(dir_path, fname), os.path.join(os.path.join(dir_path, well_name), fname))
-            logging.info('created well directories ' + str(set(well_names)))
-    #Create a dir for each well and move all the matching files to it
-#    for well_name in set(well_names):
-#        if not os.path.exists(os.path.join(dir_path, well_name)):
-#            os.makedirs(os.path.join(dir_path, well_name))
-#            for fname in os.listdir(dir_path):
-#                if fname[-3:] in input_format:
-#                    well_ind = fname.index(well_str) + len(well_str)
-#                    if well_name == ''.join([str(int(char)) for char in fname[well_ind:well_ind+2] if char.isdigit()]):
-#                        shutil.move(os.path.join(dir_path, fname), os.path.join(os.path.join(dir_path, well_name), fname))
-#
-    return set(well_names)
+def place_field(blocks, row, col, field, fnum, fill=0, max_int=None):
+    '''
+    Copy a field into its slot, rescaled to 8 bits if max_int is given. A field of another
+    size than the slot is cropped or padded with the fill value, so one odd file does not
+    break the whole well.
+    '''
+    slot = blocks[row, col]
+    if field.shape == slot.shape:
+        if max_int is None:
+            slot[...] = field
+        else:
+            rescale_field(field, max_int, slot)
+        return
+    logging.info('Field {0} is {1} instead of {2}, fitting it into its place'.format(fnum, field.shape, slot.shape))
+    slot[...] = fill
+    height, width = min(field.shape[0], slot.shape[0]), min(field.shape[1], slot.shape[1])
+    if max_int is None:
+        slot[:height, :width] = field[:height, :width]
+    else:
+        rescale_field(field[:height, :width], max_int, slot[:height, :width], field.min())
+
+
+def stitch_well(well_name, entries, img_layout, options, stitched_dir, mode='memory', canvas=None):
+    '''
+    Stitch one well and save it to the stitched directory. 'memory' holds all decoded fields
+    until the canvas is done, 'stream' and 'disk' decode one field at a time and place it right
+    away, 'disk' also keeps the canvas in a memory-mapped temporary file. If a shared `canvas`
+    is passed, the well is stitched into it and saving is left to the caller.
+    '''
+    block = out = None
+    if canvas is not None:
+        block, out = attach_array(canvas)
+    try:
+        stitched_well = stitch_canvas(well_name, entries, img_layout, options, stitched_dir, mode, out)
+        if block is None:
+            return save_well(stitched_well, well_name, options, stitched_dir)
+    finally:
+        if block is not None:
+            # Views on the block have to go before it can be closed
+            stitched_well = out = None
+            block.close()
+
+
+def stitch_canvas(well_name, entries, img_layout, options, stitched_dir, mode='memory', out=None):
+    '''
+    Stitch one well in the given mode and return its canvas, `out` if one is passed
+    '''
+    if mode == 'memory' and options.threads > 1:
+        return decode_well(entries, img_layout, options, out)
+    if mode == 'memory':
+        imgs, zeroth_field, max_int = find_images(entries, options.flip, options.projection,
+            plate_max_int(options, entries), options.rescale_intensity)
+        return stitch_images(imgs, img_layout, well_name, options.output_ext, stitched_dir, out,
+            options.fill_value, max_int if options.rescale_intensity else None)
+    logging.info('Stitching ' + well_name + ' one field at a time (' + mode + ')')
+    return stream_well(entries, img_layout, options, mode == 'disk', out)
+
+
+def decode_well(entries, img_layout, options, out=None):
+    '''
+    Stitch a well on a pool of threads that each decode, transform and place whole fields.
+    Every field has a slot of its own in the canvas, so the threads write to it without
+    locking. Without a plate max intensity, all fields are decoded first and then rescaled
+    and placed once the max intensity of the well is known.
+    '''
+    fields = OrderedDict((fnum, list(planes)) for fnum, planes in groupby(entries, key=lambda entry: entry.field))
+    for fnum in log_unplaced(fields, img_layout):
+        del fields[fnum]
+    positions = dict((img_layout[row, col], (row, col)) for row, col in zip(*np.nonzero(img_layout >= 0)))
+    rows, cols = img_layout.shape
+    if out is None:
+        shape, dtype = canvas_spec(entries, img_layout, options)
+        out = np.empty(shape, dtype=dtype)
+    blocks = canvas_blocks(out, rows, cols)
+    # The empty slots are filled up front, after that each thread only touches its own slot
+    present = np.isin(img_layout, list(fields))
+    for fnum in img_layout[(img_layout >= 0) & ~present]:
+        logging.info('Field {0} is missing, leaving its place empty'.format(fnum))
+    blocks[~present] = options.fill_value
+    max_int = plate_max_int(options, entries)
+
+    def decode(fnum):
+        field = project_field(fields[fnum], options.flip, options.projection)
+        return field, np.percentile(field, FIELD_PERCENTILE) if options.rescale_intensity and max_int is None else None
+
+    def place(fnum, field):
+        place_field(blocks, positions[fnum][0], positions[fnum][1], field, fnum, options.fill_value,
+            max_int if options.rescale_intensity else None)
+
+    with ThreadPoolExecutor(options.threads) as pool:
+        if options.rescale_intensity and max_int is None:
+            decoded = dict(zip(fields, pool.map(decode, fields)))
+            max_int = np.percentile([field_max for field, field_max in decoded.values()], PLATE_PERCENTILE)
+            list(pool.map(lambda fnum: place(fnum, decoded.pop(fnum)[0]), list(decoded)))
+        else:
+            list(pool.map(lambda fnum: place(fnum, decode(fnum)[0]), fields))
+    return out
+
+
+def save_well(stitched_well, well_name, options, stitched_dir):
+    '''
+    Encode a stitched well and save it to the stitched directory
+    '''
+    stitched_well_name = os.path.join(stitched_dir, well_name + '.' + options.output_ext)
+    to_image(stitched_well, options.output_format).save(stitched_well_name, format=options.output_format)
+    logging.info('Stitched image saved to ' + stitched_well_name + '\n')
+    return stitched_well_name
+
+
+def save_shared_well(canvas, well_name, options, stitched_dir):
+    '''
+    Save a well that another process stitched into a shared canvas
+    '''
+    block, stitched_well = attach_array(canvas)
+    try:
+        return save_well(stitched_well, well_name, options, stitched_dir)
+    finally:
+        stitched_well = None
+        block.close()
+
+
+def stream_well(entries, img_layout, options, disk, out=None):
+    '''
+    Stitch a well while holding only one decoded field per thread at a time. Each thread
+    places whole fields in their own slots, as in decode_well. With rescaling and no plate
+    estimate, the fields are read twice, first to find the max intensity and then to place
+    them.
+    '''
+    fields = [list(planes) for fnum, planes in groupby(entries, key=lambda entry: entry.field)]
+    unplaced = log_unplaced([planes[0].field for planes in fields], img_layout)
+    fields = [planes for planes in fields if planes[0].field not in unplaced]
+    max_int = plate_max_int(options, entries)
+
+    def field_max(planes):
+        return np.percentile(project_field(planes, 'none', options.projection), FIELD_PERCENTILE)
+
+    def place(planes):
+        field = project_field(planes, options.flip, options.projection)
+        row, col = positions[planes[0].field]
+        place_field(blocks, row, col, field, planes[0].field, options.fill_value, max_int)
+
+    with ThreadPoolExecutor(options.threads) as pool:
+        if options.rescale_intensity and max_int is None:
+            max_int = np.percentile(np.array(list(pool.map(field_max, fields))), PLATE_PERCENTILE)
+        rows, cols = img_layout.shape
+        positions = dict((img_layout[row, col], (row, col)) for row, col in zip(*np.nonzero(img_layout >= 0)))
+        if out is not None:
+            canvas = out
+        else:
+            shape, dtype = canvas_spec(entries, img_layout, options)
+            if disk:
+                # The canvas lives in an anonymous temporary file, so the kernel can write its
+                # pages back to disk instead of the node running out of memory
+                canvas_file = tempfile.TemporaryFile(dir=options.plate_dir, prefix='.stitch_canvas_')
+                canvas = np.memmap(canvas_file, dtype=dtype, mode='w+', shape=shape)
+            else:
+                canvas = np.empty(shape, dtype=dtype)
+        blocks = canvas_blocks(canvas, rows, cols)
+        # Every slot without a field gets the fill value up front
+        present = np.isin(img_layout, [planes[0].field for planes in fields])
+        blocks[~present] = options.fill_value
+        list(pool.map(place, fields))
+    return canvas
+
+
+def extract_roi(entries, img_layout, roi, options, offsets=None):
+    '''
+    Cut the region (x, y, width, height) in well pixel coordinates out of a well without
+    stitching it. Only the fields that overlap the region are read, and only their
+    overlapping part is copied. Parts of the region outside the well stay black.
+    '''
+    x, y, roi_width, roi_height = roi
+    # The slot size comes from the field headers, nothing is decoded yet
+    shape, dtype = well_field_spec(entries)
+    if offsets is None:
+        offsets = field_offsets(img_layout, *shape[:2])
+    overlapping = [(project_field(planes, options.flip, options.projection), box, offset)
+        for planes, box, offset in roi_fields(entries, roi, offsets, *shape[:2])]
+    logging.info('{0} of {1} fields overlap the region {2}'.format(len(overlapping), len(offsets), roi))
+    if not overlapping:
+        return np.full((roi_height, roi_width) + shape[2:], options.fill_value, dtype=dtype)
+    # main requires --intensity-sample with -s, so every region of a well has the scale the
+    # stitched well would have
+    max_int = plate_max_int(options, entries)
+    if options.rescale_intensity:
+        dtype = np.uint8
+    region = np.full((roi_height, roi_width) + shape[2:], options.fill_value, dtype=dtype)
+    for field, (y0, y1, x0, x1), (top, left) in overlapping:
+        # A field smaller than its slot is padded with the fill value, as place_field does
+        y1, x1 = min(y1, top + field.shape[0]), min(x1, left + field.shape[1])
+        if y0 >= y1 or x0 >= x1:
+            continue
+        part = field[y0-top:y1-top, x0-left:x1-left]
+        if options.rescale_intensity:
+            # The offset is the minimum of the whole field, as when the field is placed
+            rescale_field(part, max_int, region[y0-y:y1-y, x0-x:x1-x], field.min())
+        else:
+            region[y0-y:y1-y, x0-x:x1-x] = part
+    return region
+
+
+def roi_fields(entries, roi, offsets, height, width):
+    '''
+    The fields of a well that overlap the region (x, y, width, height), as their planes, the
+    overlap (y0, y1, x0, x1) in well coordinates and the offset (top, left) of the field
+    '''
+    x, y, roi_width, roi_height = roi
+    overlapping = []
+    for fnum, planes in groupby(entries, key=lambda entry: entry.field):
+        if fnum not in offsets:
+            continue
+        top, left = offsets[fnum]
+        y0, y1 = max(y, top), min(y + roi_height, top + height)
+        x0, x1 = max(x, left), min(x + roi_width, left + width)
+        if y0 < y1 and x0 < x1:
+            overlapping.append((list(planes), (y0, y1, x0, x1), (top, left)))
+    return overlapping
+
+
+def field_offsets(img_layout, height, width):
+    '''
+    Pixel offset (y, x) of each field in the stitched well
+    '''
+    return dict((int(img_layout[row, col]), (int(row*height), int(col*width)))
+        for row, col in zip(*np.nonzero(img_layout >= 0)))
+
+
+def to_image(canvas, output_format):
+    '''
+    Wrap a stitched canvas in a PIL image for saving. JPEG only holds 8 bits, deeper canvases
+    are clipped to 0-255 the same way pasting them into an RGB image used to.
+    '''
+    if canvas.dtype != np.uint8 and output_format.lower() in ('jpeg', 'jpg'):
+        canvas = np.clip(canvas, 0, 255).astype(np.uint8)
+    return Image.fromarray(canvas)
+
+
+def sort_fields(dir_path, table, by_well, by_channel, channel_prefix):
+    '''
+    Move the files in the field table into one subfolder per well and/or channel
+    '''
+    folders = set()
+    for entry in table:
+        folder = group_name((entry.well if by_well else None,
+            entry.channel if by_channel else None, None, None), channel_prefix)
+        if folder not in folders:
+            folders.add(folder)
+            if not os.path.exists(os.path.join(dir_path, folder)):
+                os.makedirs(os.path.join(dir_path, folder))
+        fname = os.path.basename(entry.path)
+        #move the current file to the new directory
+        logging.info('moving ./' + fname + ' to ./' + os.path.join(folder, fname))
+        shutil.move(entry.path, os.path.join(dir_path, folder, fname))
+    logging.info('created directories ' + str(sorted(folders, key=nat_key)))
+
+    return folders
 
 #if I craete a dict with well names and the files, I can use the well name to create:
 #the stitched file in the script level directory and use the well name to separate them instead
 #come up with a new way to find the field name since the well string is now variable, either portion just
 #behind it or between it and the well string %w?
 
+# File in the plate directory that keeps the well geometry between runs
+GEOMETRY_FILE = '.stitch_geometry.json'
+
+
+class GeometryCache(object):
+    '''
+    Field layouts and field offsets per well, stored in a JSON file in the plate directory so
+    later timepoints and runs reuse them. A stored geometry is only used while the field
+    numbers, scan direction and field size it was computed for are unchanged.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.wells = {}
+        self.changed = False
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.wells = json.load(f)
+            except ValueError:
+                logging.info('Ignoring the unreadable geometry cache ' + path)
+
+    def layout(self, entries, scan_direction):
+        '''
+        The layout of a well, from the cache if its settings have not changed
+        '''
+        key, settings = self.settings(entries, scan_direction)
+        cached = self.wells.get(key)
+        if cached is not None and cached['settings'] == settings:
+            img_layout = np.array(cached['layout'], dtype=int)
+            log_layout(img_layout, 'Field layout (cached):')
+            return img_layout
+        fnums = settings['fields']
+        img_layout = field_layout(layout_size(fnums), 0 in fnums, scan_direction)
+        offsets = dict((str(fnum), list(offset))
+            for fnum, offset in field_offsets(img_layout, *settings['field_size']).items())
+        self.wells[key] = {'settings': settings, 'layout': img_layout.tolist(), 'offsets': offsets}
+        self.changed = True
+        return img_layout
+
+    def offsets(self, entries, scan_direction):
+        '''
+        Pixel offset (y, x) of each field in the stitched well
+        '''
+        key, settings = self.settings(entries, scan_direction)
+        self.layout(entries, scan_direction)
+        return dict((int(fnum), tuple(offset)) for fnum, offset in self.wells[key]['offsets'].items())
+
+    def settings(self, entries, scan_direction):
+        # Timepoints and z-planes of a well share one geometry, so they are not in the key
+        key = '{0}/{1}/{2}'.format(os.path.basename(os.path.dirname(os.path.abspath(entries[0].path))),
+            entries[0].well, entries[0].channel)
+        height, width = well_field_spec(entries)[0][:2]
+        fnums = sorted(set(entry.field for entry in entries))
+        # The number of positions is stored too, layouts from before gaps in the field
+        # numbers were kept open do not match it and are worked out again
+        settings = {'fields': fnums, 'positions': layout_size(fnums),
+            'scan_direction': scan_direction, 'field_size': [height, width]}
+        return key, settings
+
+    def save(self):
+        '''
+        Write the cache if anything changed, through a temporary file so an interrupted run
+        cannot leave half a file behind
+        '''
+        if not self.changed:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.wells, f)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+
+# File in the plate directory that keeps the sampled plate intensities between runs
+INTENSITY_FILE = '.stitch_intensity.json'
+# The same statistic find_images computes per well: a high percentile of every field, and a
+# percentile of those across the fields
+FIELD_PERCENTILE = 99.999
+PLATE_PERCENTILE = 70
+
+
+def plate_intensity(wells, options):
+    '''
+    Max intensity per channel for --rescale_intensity, estimated once for the whole plate
+    from a sample of its fields. The estimate is stored in the plate directory and reused
+    while the plate's fields, their sizes and modification times, the sample fraction and
+    the projection are unchanged.
+    '''
+    path = os.path.join(options.plate_dir, INTENSITY_FILE)
+    cached = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except ValueError:
+            logging.info('Ignoring the unreadable intensity cache ' + path)
+    strata = OrderedDict()
+    for well_name, entries in wells:
+        fields = [list(planes) for fnum, planes in groupby(entries, key=lambda entry: entry.field)]
+        strata.setdefault(entries[0].channel, []).append(fields)
+    max_ints = {}
+    changed = False
+    for channel, channel_wells in strata.items():
+        # JSON keys are strings
+        key = str(channel)
+        settings = {'fraction': options.intensity_sample, 'projection': options.projection,
+            'fields': sorted([entry.path] + list(field_version(entry.path))
+                for fields in channel_wells for planes in fields for entry in planes)}
+        estimate = cached.get(key)
+        if estimate is None or estimate['settings'] != settings:
+            estimate = estimate_intensity(channel_wells, options)
+            estimate['settings'] = settings
+            cached[key] = estimate
+            changed = True
+            source = 'sampled'
+        else:
+            source = 'cached'
+        line = 'Channel {0} max intensity {1:.1f} (95% interval {2:.1f}-{3:.1f}), {5} from {4[0]} of {4[1]} ' \
+            'fields'.format(channel, estimate['max_int'], estimate['low'], estimate['high'], estimate['sampled'],
+            source)
+        print(line)
+        logging.info(line)
+        max_ints[channel] = estimate['max_int']
+    if changed:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f)
+        os.rename(tmp_path, path)
+    return max_ints
+
+
+def estimate_intensity(channel_wells, options, seed=0):
+    '''
+    Read a stratified random sample of the fields of one channel, the same fraction from
+    every well, and estimate the plate percentile of their max intensities. The error bound
+    is the distribution-free 95% confidence interval of a percentile, from the ranks of the
+    sample around it, narrowed by how much of the plate was sampled.
+    '''
+    rng = random.Random(seed)
+    sample = []
+    total = 0
+    for fields in channel_wells:
+        total += len(fields)
+        size = min(len(fields), max(1, int(round(options.intensity_sample * len(fields)))))
+        sample.extend(rng.sample(fields, size))
+    def field_max(planes):
+        return float(np.percentile(project_field(planes, 'none', options.projection), FIELD_PERCENTILE))
+    # Fields in an archive are read in the order they are stored
+    sample.sort(key=lambda planes: archive_order(planes[0].path))
+    with ThreadPoolExecutor(max(1, options.workers)) as pool:
+        values = np.sort(list(pool.map(field_max, sample)))
+    n = len(values)
+    q = PLATE_PERCENTILE / 100
+    # Finite population correction, sampling every field leaves no error
+    spread = 1.96 * np.sqrt(n * q * (1 - q) * ((total - n) / (total - 1) if total > 1 else 0))
+    max_int = float(np.percentile(values, PLATE_PERCENTILE))
+    low = high = max_int
+    if spread:
+        low = values[max(0, int(np.floor(n * q - spread)) - 1)]
+        high = values[min(n - 1, int(np.ceil(n * q + spread)))]
+    return {'max_int': max_int, 'low': float(low), 'high': float(high), 'sampled': [n, total]}
+
+
+def plate_max_int(options, entries):
+    '''
+    The plate estimate of the max intensity for the channel of a well, or None when each
+    well finds its own
+    '''
+    if not options.rescale_intensity or options.plate_max_int is None:
+        return None
+    return options.plate_max_int.get(entries[0].channel)
+
+
+# A full field cache is trimmed to this part of its size limit, so the directory is not
+# rescanned on every store
+FIELD_CACHE_LOW_WATER = 0.9
+
+
+class FieldCache(object):
+    '''
+    Decoded fields stored as .npy files in a cache directory, keyed by the path, size and
+    modification time of the field file, and read back when they are used again. Only
+    fields that cannot be read straight from their own file are cached. The least
+    recently used fields are removed once the cache grows past max_bytes, until it is down
+    to FIELD_CACHE_LOW_WATER of it.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.total = sum(size for path, size, used in self.entries())
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def key(self, path):
+        token = '{0}\0{1}\0{2}'.format(os.path.abspath(path), *field_version(path))
+        return os.path.join(self.directory, hashlib.sha1(token.encode('utf-8')).hexdigest() + '.npy')
+
+    def load(self, path):
+        '''
+        The cached field, or None. It is read rather than memory-mapped, so no file stays open
+        '''
+        cache_path = self.key(path)
+        try:
+            field = np.load(cache_path)
+        except (IOError, OSError, ValueError):
+            return None
+        # The modification time of a cache file is when it was last used
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        return field
+
+    def store(self, path, field):
+        '''
+        Add a decoded field, written under a temporary name so readers never see half a file
+        '''
+        cache_path = self.key(path)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(cache_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(field))
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError) as error:
+            logging.info('Could not cache {0}: {1}'.format(path, error))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.total += os.path.getsize(cache_path)
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        '''
+        (path, size, last used) of the cached fields
+        '''
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, fname))
+                except OSError: # removed by another process
+                    continue
+                entries.append((os.path.join(self.directory, fname), stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        # Other processes share the directory, so the total is recounted from the files
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.total = sum(size for path, size, used in entries)
+        for path, size, used in entries:
+            if self.total <= self.max_bytes * FIELD_CACHE_LOW_WATER:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total -= size
+            logging.info('Removed ' + path + ' from the field cache')
+
+
+def field_version(path):
+    '''
+    Size and modification time of a field, those of the archive for a member of one. A
+    field that is written again gets a new version.
+    '''
+    archive, member = split_member(path)
+    return field_size(path), os.stat(archive if archive is not None else path).st_mtime
+
+
+# The field cache of this process, set by init_field_cache
+_field_cache = None
+
+
+def init_field_cache(directory, max_bytes):
+    '''
+    Use a field cache in this process, also the initializer of the worker processes
+    '''
+    global _field_cache
+    _field_cache = FieldCache(directory, max_bytes) if directory is not None else None
+
+
+# Bytes per pixel of the PIL image modes
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I': 4, 'F': 4,
+    'RGB': 3, 'RGBA': 4}
+
+
+# Numpy dtypes of the PIL image modes, as read_field returns them
+MODE_DTYPES = {'1': '|b1', 'L': '|u1', 'LA': '|u1', 'P': '|u1', 'I;16': '<u2', 'I;16L': '<u2', 'I;16B': '>u2',
+    'I': '<i4', 'F': '<f4', 'RGB': '|u1', 'RGBA': '|u1'}
+
+
+def field_spec(path):
+    '''
+    Shape and dtype string of a field as read_field returns it, from its header only
+    '''
+    img = Image.open(open_field(path))
+    if img.mode not in MODE_DTYPES:
+        field = read_field(path, 'none')
+        return field.shape, field.dtype.str
+    # Palette images are converted to RGB when they are read
+    bands = 3 if img.mode == 'P' else len(img.getbands())
+    width, height = img.size
+    return (height, width) + ((bands,) if bands > 1 else ()), MODE_DTYPES[img.mode]
+
+
+def well_field_spec(entries):
+    '''
+    The field shape most fields of a well have and the dtype that holds all of them, from
+    the headers. Every stitching mode sizes the slots of the canvas from it.
+    '''
+    specs = [field_spec(next(planes).path) for fnum, planes in groupby(entries, key=lambda entry: entry.field)]
+    shape = Counter(shape for shape, dtype in specs).most_common(1)[0][0]
+    return shape, np.result_type(*[np.dtype(dtype) for shape, dtype in specs])
+
+
+def estimate_well_memory(entries, img_layout, mode='memory', threads=1):
+    '''
+    Estimate the peak memory in bytes of stitching a well in the given mode with a number of
+    threads. Only the header of the first field is read, the field count and the layout
+    come from the field table.
+    '''
+    img = Image.open(open_field(entries[0].path))
+    width, height = img.size
+    field_bytes = width * height * MODE_BYTES.get(img.mode, 4)
+    # np.percentile and mean projections make float64 copies of one field at a time, the
+    # rescaling only works on bands of rows
+    scratch_bytes = width * height * 8 * 2 * threads
+    rows, cols = img_layout.shape
+    canvas_bytes = rows * cols * field_bytes
+    if mode == 'memory':
+        fields = len(set(entry.field for entry in entries))
+        return fields * field_bytes + canvas_bytes + scratch_bytes
+    # Every thread holds one decoded field
+    elif mode == 'stream':
+        return threads * field_bytes + canvas_bytes + scratch_bytes
+    return threads * field_bytes + scratch_bytes
+
+
+def choose_mode(entries, img_layout, memory_budget, threads=1):
+    '''
+    Pick the cheapest way of stitching a well that fits in the memory budget. Returns the
+    mode and its estimated peak memory, the disk mode is the last resort.
+    '''
+    for mode in ('memory', 'stream', 'disk'):
+        need = estimate_well_memory(entries, img_layout, mode, threads)
+        if memory_budget is None or need <= memory_budget:
+            break
+    return mode, need
+
+
+# Header reads are mostly waiting on the disk, so pre-flight uses more threads than cores
+PREFLIGHT_THREADS = 16
+
+
+def read_header(path):
+    '''
+    Read only the header of a field file. Returns the size, mode and bits per pixel, and the
+    file size the header implies for uncompressed BMP and TIFF files (None for others).
+    '''
+    with open_field(path) as f:
+        expected_bytes = expected_size(f)
+        f.seek(0)
+        img = Image.open(f)
+    return img.size, img.mode, MODE_BYTES.get(img.mode, 4) * 8, expected_bytes
+
+
+def expected_size(f):
+    '''
+    File size implied by the headers of an uncompressed BMP or of a TIFF file, from the
+    pixel offset and row size or from the end of the last strip. None for other files.
+    '''
+    magic = f.read(4)
+    f.seek(0)
+    try:
+        if magic[:2] == b'BM':
+            header = bmp_header(f)
+            if header is None or header[5] != 0:
+                return None
+            offset, dib_size, width, height, bits = header[:5]
+            return offset + abs(height) * ((width * bits // 8 + 3) & ~3)
+        if magic in (b'II*\x00', b'MM\x00*'):
+            endian, tags = tiff_tags(f)
+            return max(offset + count for offset, count in zip(tags[273], tags[279]))
+    except (KeyError, ValueError, struct.error):
+        pass
+    return None
+
+
+def check_field(entry):
+    '''
+    Pre-flight check of one field, returns its header or the problem with it
+    '''
+    try:
+        size, mode, bits, expected_bytes = read_header(entry.path)
+    except (IOError, OSError, SyntaxError, ValueError) as error:
+        return None, 'field {0} cannot be read ({1})'.format(entry.field, error)
+    actual_bytes = field_size(entry.path)
+    if expected_bytes is not None and actual_bytes < expected_bytes:
+        return None, 'field {0} is truncated ({1} of {2} bytes)'.format(entry.field, actual_bytes, expected_bytes)
+    return (size, mode, bits), None
+
+
+def preflight_plate(wells, options):
+    '''
+    Check every field of the plate in parallel by reading headers only: readable, not
+    truncated, and the same dimensions, mode and bit depth as the rest of its well. Also
+    checks that each well has every field number from its first to its highest one, and
+    that each field has a place in the field layout. Returns the problems per well name,
+    and prints and logs a report.
+    '''
+    # Members of an archive are checked in the order they are stored
+    entries = sorted((entry for well_name, well_entries in wells for entry in well_entries),
+        key=lambda entry: archive_order(entry.path))
+    with ThreadPoolExecutor(max(PREFLIGHT_THREADS, options.workers)) as pool:
+        checked = dict(zip(entries, pool.map(check_field, entries)))
+    problems = OrderedDict()
+    for well_name, well_entries in wells:
+        messages = [checked[entry][1] for entry in well_entries if checked[entry][1] is not None]
+        headers = Counter(checked[entry][0] for entry in well_entries if checked[entry][0] is not None)
+        if len(headers) > 1:
+            common = headers.most_common(1)[0][0]
+            for entry in well_entries:
+                header = checked[entry][0]
+                if header is not None and header != common:
+                    messages.append('field {0} is {1[0][0]}x{1[0][1]} {1[1]} ({1[2]} bit) instead of '
+                        '{2[0][0]}x{2[0][1]} {2[1]} ({2[2]} bit)'.format(entry.field, header, common))
+        fnums = set(entry.field for entry in well_entries)
+        missing = set(range(min(fnums), max(fnums) + 1)) - fnums
+        if missing:
+            messages.append('field{0} {1} {2} missing'.format('s' if len(missing) > 1 else '',
+                ', '.join(str(fnum) for fnum in sorted(missing)), 'are' if len(missing) > 1 else 'is'))
+        img_layout = well_layout(well_entries, options.scan_direction)
+        outside = fnums - set(img_layout[img_layout >= 0].tolist())
+        if outside:
+            messages.append('field{0} {1} {2} outside the field layout'.format('s' if len(outside) > 1 else '',
+                ', '.join(str(fnum) for fnum in sorted(outside)), 'are' if len(outside) > 1 else 'is'))
+        if messages:
+            problems[well_name] = messages
+    report = ['Pre-flight check of {0} wells, {1} fields: {2} wells with problems'.format(
+        len(wells), len(entries), len(problems))]
+    for well_name, messages in problems.items():
+        report.append('  {0}: {1}'.format(well_name, '; '.join(messages)))
+    print('\n' + '\n'.join(report))
+    for line in report:
+        logging.info(line)
+    return problems
+
+
+def canvas_spec(entries, img_layout, options):
+    '''
+    Shape and dtype of the stitched canvas of a well, from the field headers and the layout
+    '''
+    shape, dtype = well_field_spec(entries)
+    if options.rescale_intensity:
+        dtype = np.uint8
+    rows, cols = img_layout.shape
+    return (rows*shape[0], cols*shape[1]) + shape[2:], dtype
+
+
+def schedule_wells(wells, options, stitched_dir, geometry=None):
+    '''
+    Stitch wells on a pool of worker processes. A well is only started once its estimated
+    peak memory fits in the budget next to the wells already running. The largest wells go
+    first so the small ones can pack the remaining space.
+
+    Wells are stitched into shared memory canvases and saved by a separate task, so only
+    the canvas descriptors are pickled between processes. The budget of a well is held
+    until its image is saved. The canvases are counted by the blocks they are on, and the
+    released blocks kept for reuse count against the budget as well.
+    '''
+    canvases = SharedArrayPool() if shared_memory is not None else None
+    jobs = []
+    for well_name, entries in wells:
+        img_layout = well_layout(entries, options.scan_direction, geometry)
+        mode, need = choose_mode(entries, img_layout, options.memory_budget, options.threads)
+        # Disk-backed wells are too big to keep in memory, they are saved in place
+        spec = None
+        if canvases is not None and mode != 'disk':
+            spec = canvas_spec(entries, img_layout, options)
+        jobs.append((need, well_name, entries, img_layout, mode, spec))
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    num_wells = len(jobs)
+    num = 0
+    # Memory of the running wells besides their shared canvases
+    in_use = 0
+    running = {}
+    try:
+        # The workers use the same field cache
+        cache_args = (_field_cache.directory, _field_cache.max_bytes) if _field_cache is not None else (None, 0)
+        with ProcessPoolExecutor(options.workers, initializer=init_field_cache, initargs=cache_args) as pool:
+            while jobs or running:
+                # Admit every waiting well that fits, a well that is too big for the budget on
+                # its own still runs once nothing else is
+                for job in list(jobs):
+                    if len(running) >= options.workers:
+                        break
+                    need, well_name, entries, img_layout, mode, spec = job
+                    own, shared = need, canvases.nbytes() if canvases is not None else 0
+                    if spec is not None:
+                        own = max(need - array_bytes(*spec), 0)
+                        shared = canvases.nbytes_after(*spec)
+                    if running and options.memory_budget is not None and \
+                            in_use + own + shared > options.memory_budget:
+                        continue
+                    jobs.remove(job)
+                    canvas = None
+                    if spec is not None:
+                        canvas = canvases.acquire(*spec)
+                    future = pool.submit(stitch_well, well_name, entries, img_layout, options, stitched_dir, mode,
+                        canvas)
+                    running[future] = (job, canvas, 'stitch', own)
+                    in_use += own
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job, canvas, stage, own = running.pop(future)
+                    future.result()
+                    if stage == 'stitch' and canvas is not None:
+                        future = pool.submit(save_shared_well, canvas, job[1], options, stitched_dir)
+                        running[future] = (job, canvas, 'save', own)
+                        continue
+                    if canvas is not None:
+                        canvases.release(canvas)
+                    in_use -= own
+                    num += 1
+                    progress = int(num / num_wells * 100)
+                    print('{0}% {1} '.format(progress, job[1]), end='\r')
+                    sys.stdout.flush()
+    finally:
+        if canvases is not None:
+            canvases.close()
+
+
+# Output types the planner knows about, and the longest side of a well in the plate overview
+OUTPUTS = ('wells', 'overview', 'pyramid', 'archive')
+OVERVIEW_WELL_SIZE = 256
+
+# The plate archive: a header, the wells one after the other, a JSON index of where each well
+# is, and a trailer with the offset and length of the index
+ARCHIVE_FILE = 'wells.stitch'
+ARCHIVE_MAGIC = b'STITCHAR'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct('<8sI4x')
+ARCHIVE_TRAILER = struct.Struct('<QQ8s')
+ARCHIVE_CODECS = ('raw', 'zlib', 'image')
+# Wells start on page boundaries so raw wells can be memory-mapped, and are written through
+# a large buffer so the file system sees few, big writes
+ARCHIVE_ALIGN = 4096
+ARCHIVE_BUFFER = 16 * 2**20
+
+# Order of the task stages, later stages are started first so results do not pile up
+STAGES = ('layout', 'stitch', 'thumbnail', 'encode')
+
+
+class Task(object):
+    '''
+    One node of the plan. Runs func(*args) followed by the results of its dependencies,
+    cost is the estimated number of bytes it reads or writes. memory is its estimated peak
+    memory while it runs and held what its result keeps in memory until it is dropped.
+    '''
+    def __init__(self, stage, func, args, deps, cost, memory=0, held=0):
+        self.stage = stage
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.cost = cost
+        self.memory = memory
+        self.held = held
+
+
+def plan_outputs(wells, outputs, options, stitched_dir, geometry=None, archive=None):
+    '''
+    Turn the requested outputs into a graph of layout -> stitch -> encode tasks. Each well is
+    stitched once, in the mode choose_mode picks for the memory budget, and its canvas is
+    fanned out to every output that needs it. Wells with the same field numbers share one
+    layout task.
+    '''
+    tasks = OrderedDict()
+    thumbnails = OrderedDict()
+    for well_name, entries in wells:
+        fnums = set(entry.field for entry in entries)
+        layout = 'layout {0} fields{1}'.format(layout_size(fnums), ' from 0' if 0 in fnums else '')
+        if layout not in tasks:
+            tasks[layout] = Task('layout', well_layout, (entries, options.scan_direction, geometry), (), 0)
+        img_layout = well_layout(entries, options.scan_direction, geometry)
+        shape, dtype = canvas_spec(entries, img_layout, options)
+        canvas_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        mode, need = choose_mode(entries, img_layout, options.memory_budget, options.threads)
+        place = 'stitch ' + well_name
+        # A disk-backed canvas stays out of memory while the outputs are made from it
+        tasks[place] = Task('stitch', stitch_task, (well_name, entries, options, stitched_dir, mode), (layout,),
+            sum(field_size(entry.path) for entry in entries), need, canvas_bytes if mode != 'disk' else 0)
+        # Encoding makes an image copy of the canvas
+        if 'wells' in outputs:
+            tasks['encode well ' + well_name] = Task('encode', save_well_task, (well_name, options, stitched_dir),
+                (place,), canvas_bytes, canvas_bytes)
+        if 'archive' in outputs:
+            tasks['encode archive ' + well_name] = Task('encode', archive.append, (well_name, entries[0]), (place,),
+                canvas_bytes, canvas_bytes)
+        if 'pyramid' in outputs:
+            # Each level is a quarter of the one before, the whole pyramid is a third more
+            tasks['encode pyramid ' + well_name] = Task('encode', save_pyramid, (well_name, options, stitched_dir),
+                (place,), canvas_bytes * 4 // 3, canvas_bytes * 4 // 3)
+        if 'overview' in outputs:
+            position = well_position(entries[0].well)
+            if position is None:
+                logging.info('Leaving ' + well_name + ' out of the overview, its well id has no row and column')
+                continue
+            thumbnail = 'thumbnail ' + well_name
+            tasks[thumbnail] = Task('thumbnail', make_thumbnail, (OVERVIEW_WELL_SIZE,), (place,), canvas_bytes)
+            thumbnails.setdefault(entries[0].channel, []).append((thumbnail, position))
+    for channel, channel_thumbnails in thumbnails.items():
+        name = group_name(('overview', channel, None, None), options.channel_prefix)
+        positions = [position for thumbnail, position in channel_thumbnails]
+        deps = tuple(thumbnail for thumbnail, position in channel_thumbnails)
+        tasks['encode ' + name] = Task('encode', save_overview, (name, positions, options, stitched_dir), deps,
+            len(deps) * OVERVIEW_WELL_SIZE**2)
+    return tasks
+
+
+def run_plan(tasks, workers, memory_budget=None):
+    '''
+    Run a plan on a pool of `workers` threads, each task as soon as its dependencies are
+    done. A result is dropped once every task that needs it has run, so stitched wells do
+    not pile up. With a memory budget, a task only starts if its memory fits next to the
+    running tasks and the results still held, or if nothing else is running.
+    '''
+    consumers = dict((name, 0) for name in tasks)
+    for task in tasks.values():
+        for dep in task.deps:
+            consumers[dep] += 1
+    order = dict((name, num) for num, name in enumerate(tasks))
+    waiting = set(tasks)
+    results = {}
+    running = {}
+    in_use = 0
+    num = 0
+    with ThreadPoolExecutor(workers) as pool:
+        while waiting or running:
+            ready = [name for name in waiting if all(dep in results for dep in tasks[name].deps)]
+            ready.sort(key=lambda name: (-STAGES.index(tasks[name].stage), order[name]))
+            for name in ready:
+                if len(running) >= workers:
+                    break
+                task = tasks[name]
+                if running and memory_budget is not None and in_use + task.memory > memory_budget:
+                    continue
+                waiting.remove(name)
+                in_use += task.memory
+                args = task.args + tuple(results[dep] for dep in task.deps)
+                running[pool.submit(task.func, *args)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                # The working memory of the task is free again, what its result holds is not
+                in_use += tasks[name].held - tasks[name].memory
+                for dep in tasks[name].deps:
+                    consumers[dep] -= 1
+                    if consumers[dep] == 0:
+                        del results[dep]
+                        in_use -= tasks[dep].held
+                if consumers[name] == 0:
+                    del results[name]
+                    in_use -= tasks[name].held
+                num += 1
+                progress = int(num / len(tasks) * 100)
+                print('{0}% {1} '.format(progress, name), end='\r')
+                sys.stdout.flush()
+
+
+def print_roi_plan(wells, options, geometry):
+    '''
+    Print the fields each well would read for --roi, from the field headers only
+    '''
+    print('\nFields overlapping the region {0}:'.format(options.roi))
+    total = 0
+    for well_name, entries in wells:
+        img_layout = well_layout(entries, options.scan_direction, geometry)
+        shape, dtype = well_field_spec(entries)
+        offsets = None
+        if geometry is not None:
+            offsets = geometry.offsets(entries, options.scan_direction)
+        if offsets is None:
+            offsets = field_offsets(img_layout, *shape[:2])
+        overlapping = roi_fields(entries, options.roi, offsets, *shape[:2])
+        cost = sum(field_size(entry.path) for planes, box, offset in overlapping for entry in planes)
+        total += cost
+        print('{0:<40} {1:>4} of {2:<4} fields {3:>10}'.format(well_name, len(overlapping), len(offsets),
+            format_size(cost)))
+    print('\n{0} to read'.format(format_size(total)))
+
+
+def print_plan(tasks):
+    '''
+    Print the tasks of a plan with their dependencies and estimated cost
+    '''
+    print('\nPlan:')
+    print('{0:<40} {1:>10} {2:>10}'.format('task', 'bytes', 'memory'))
+    for name, task in tasks.items():
+        print('{0:<40} {1:>10} {2:>10}   <- {3}'.format(name, format_size(task.cost), format_size(task.memory),
+            ', '.join(task.deps) or '-'))
+    print('\nEstimated cost:')
+    for stage in STAGES:
+        stage_tasks = [task for task in tasks.values() if task.stage == stage]
+        if stage_tasks:
+            print('{0:<12} {1:>5} tasks {2:>10}'.format(stage, len(stage_tasks),
+                format_size(sum(task.cost for task in stage_tasks))))
+    fanned_out = sum(1 for task in tasks.values() if task.stage in ('encode', 'thumbnail') and
+        any(dep.startswith('stitch ') for dep in task.deps))
+    decodes = sum(1 for task in tasks.values() if task.stage == 'stitch')
+    print('{0} wells are decoded once for {1} outputs'.format(decodes, fanned_out))
+
+
+def stitch_task(well_name, entries, options, stitched_dir, mode, img_layout):
+    return stitch_canvas(well_name, entries, img_layout, options, stitched_dir, mode)
+
+
+def save_well_task(well_name, options, stitched_dir, stitched_well):
+    return save_well(stitched_well, well_name, options, stitched_dir)
+
+
+def save_pyramid(well_name, options, stitched_dir, stitched_well):
+    '''
+    Save a well at full size and then halved until it fits in one overview tile
+    '''
+    pyramid_dir = os.path.join(stitched_dir, 'pyramids')
+    if not os.path.exists(pyramid_dir):
+        try:
+            os.makedirs(pyramid_dir)
+        except OSError: # another thread made it first
+            pass
+    level = 0
+    while True:
+        level_name = os.path.join(pyramid_dir, '{0}_L{1}.{2}'.format(well_name, level, options.output_ext))
+        to_image(stitched_well, options.output_format).save(level_name, format=options.output_format)
+        if max(stitched_well.shape[:2]) <= OVERVIEW_WELL_SIZE:
+            break
+        stitched_well = downsample(stitched_well, 2)
+        level += 1
+    logging.info('Pyramid of {0} levels saved for {1}'.format(level + 1, well_name))
+
+
+def make_thumbnail(size, stitched_well):
+    '''
+    Shrink a canvas so its longest side is at most `size`
+    '''
+    return downsample(stitched_well, int(np.ceil(max(stitched_well.shape[:2]) / size)))
+
+
+def downsample(canvas, factor):
+    '''
+    Shrink a canvas by averaging blocks of factor x factor pixels
+    '''
+    if factor <= 1:
+        return canvas
+    height = canvas.shape[0] // factor * factor
+    width = canvas.shape[1] // factor * factor
+    blocks = canvas[:height, :width].reshape((height // factor, factor, width // factor, factor) + canvas.shape[2:])
+    return blocks.mean(axis=(1, 3)).astype(canvas.dtype)
+
+
+def save_overview(name, positions, options, stitched_dir, *thumbnails):
+    '''
+    Lay out the well thumbnails of one channel on the plate grid and save the plate overview
+    '''
+    tile_height = max(thumbnail.shape[0] for thumbnail in thumbnails)
+    tile_width = max(thumbnail.shape[1] for thumbnail in thumbnails)
+    rows = max(row for row, col in positions) + 1
+    cols = max(col for row, col in positions) + 1
+    overview = np.zeros((rows*tile_height, cols*tile_width) + thumbnails[0].shape[2:], dtype=thumbnails[0].dtype)
+    for (row, col), thumbnail in zip(positions, thumbnails):
+        height, width = thumbnail.shape[:2]
+        overview[row*tile_height:row*tile_height+height, col*tile_width:col*tile_width+width] = thumbnail
+    overview_name = os.path.join(stitched_dir, name + '.' + options.output_ext)
+    to_image(overview, options.output_format).save(overview_name, format=options.output_format)
+    logging.info('Plate overview saved to ' + overview_name)
+    return overview_name
+
+
+class ArchiveWriter(object):
+    '''
+    Appends stitched wells to a single archive file as they finish, so a plate is one file
+    instead of one per well. Wells are encoded by the calling thread and written in one
+    sequential piece under a lock. The file is only created by the first well.
+    '''
+    def __init__(self, path, codec='raw', output_format='png'):
+        self.path = path
+        self.codec = codec
+        self.output_format = output_format
+        self.index = []
+        self.lock = threading.Lock()
+        self.f = None
+
+    def append(self, well_name, entry, stitched_well):
+        '''
+        Encode a well and append it, `entry` is one of its fields for the well and channel ids
+        '''
+        stitched_well = np.ascontiguousarray(stitched_well)
+        if self.codec == 'raw':
+            data = stitched_well.reshape(-1).view(np.uint8)
+        elif self.codec == 'zlib':
+            data = zlib.compress(stitched_well.reshape(-1).view(np.uint8), 1)
+        else:
+            buf = io.BytesIO()
+            to_image(stitched_well, self.output_format).save(buf, format=self.output_format)
+            data = buf.getvalue()
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.path, 'wb', ARCHIVE_BUFFER)
+                self.f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION))
+            padding = -self.f.tell() % ARCHIVE_ALIGN
+            self.f.write(b'\0' * padding)
+            offset = self.f.tell()
+            self.f.write(data)
+            self.index.append({'name': well_name, 'well': entry.well, 'channel': entry.channel,
+                'z': entry.z, 't': entry.t, 'offset': offset, 'nbytes': len(data),
+                'shape': list(stitched_well.shape), 'dtype': stitched_well.dtype.str,
+                'codec': self.codec if self.codec != 'image' else self.output_format.lower()})
+        logging.info('{0} appended to {1} at byte {2}'.format(well_name, self.path, offset))
+        return self.path
+
+    def close(self):
+        '''
+        Write the index and the trailer that points to it
+        '''
+        with self.lock:
+            if self.f is None:
+                return
+            index = json.dumps(self.index).encode('utf-8')
+            index_offset = self.f.tell()
+            self.f.write(index)
+            self.f.write(ARCHIVE_TRAILER.pack(index_offset, len(index), ARCHIVE_MAGIC))
+            self.f.close()
+            self.f = None
+        logging.info('Archive of {0} wells saved to {1}'.format(len(self.index), self.path))
+
+
+class ArchiveReader(object):
+    '''
+    Random access to the wells of a plate archive. The index is read from the end of the
+    file once, after that every well is a single seek and read. Raw wells can also be
+    memory-mapped.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version = ARCHIVE_HEADER.unpack(f.read(ARCHIVE_HEADER.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(path + ' is not a plate archive')
+            if version > ARCHIVE_VERSION:
+                raise ValueError('{0} is archive version {1}, this script reads up to {2}'.format(
+                    path, version, ARCHIVE_VERSION))
+            f.seek(-ARCHIVE_TRAILER.size, os.SEEK_END)
+            index_offset, index_bytes, magic = ARCHIVE_TRAILER.unpack(f.read(ARCHIVE_TRAILER.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(path + ' has no index, it was not closed')
+            f.seek(index_offset)
+            self.index = json.loads(f.read(index_bytes).decode('utf-8'))
+        self.by_name = dict((item['name'], item) for item in self.index)
+        self.by_well = dict(((item['well'], item['channel'], item['z'], item['t']), item) for item in self.index)
+
+    def find(self, well, channel=None, z=None, t=None):
+        '''
+        The index entry of a stitched well name, or of a well id with its channel, z and t
+        '''
+        item = self.by_name.get(well)
+        if item is None:
+            item = self.by_well.get((well, channel, z, t))
+        if item is None:
+            raise KeyError('{0} is not in {1}'.format(well, self.path))
+        return item
+
+    def read(self, well, channel=None, z=None, t=None, mmap=False):
+        '''
+        Read one well. With mmap, a raw well is returned as a read-only memory map instead.
+        '''
+        item = self.find(well, channel, z, t)
+        shape, dtype = tuple(item['shape']), np.dtype(item['dtype'])
+        if mmap and item['codec'] == 'raw':
+            return np.memmap(self.path, dtype=dtype, mode='r', offset=item['offset'], shape=shape)
+        with open(self.path, 'rb') as f:
+            f.seek(item['offset'])
+            data = f.read(item['nbytes'])
+        if item['codec'] == 'raw':
+            return np.frombuffer(data, dtype=dtype).reshape(shape)
+        if item['codec'] == 'zlib':
+            return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+        return np.asarray(Image.open(io.BytesIO(data)))
+
+
+def well_position(well):
+    '''
+    Zero-based (row, column) of a well id such as A01 or AB12
+    '''
+    parsed = re.match(r'([A-Za-z]+)(\d+)$', well or '')
+    if parsed is None:
+        return None
+    row = 0
+    for char in parsed.group(1).upper():
+        row = row * 26 + ord(char) - ord('A') + 1
+    return row - 1, int(parsed.group(2)) - 1
+
+
+def parse_outputs(outputs):
+    '''
+    Split and check a comma separated list of outputs
+    '''
+    outputs = [output.strip() for output in outputs.split(',') if output.strip()]
+    for output in outputs:
+        if output not in OUTPUTS:
+            raise argparse.ArgumentTypeError('unknown output ' + output + ', choose from ' + ', '.join(OUTPUTS))
+    return outputs
+
+
+def format_size(size):
+    '''
+    Human readable size in bytes, the reverse of parse_size
+    '''
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024
+    return '{0:.1f}{1}B'.format(size, unit) if unit else '{0}B'.format(size)
+
+
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+
+class SharedArrayPool(object):
+    '''
+    Shared memory blocks for handing arrays between processes. Released blocks are reused
+    for later arrays that fit. Every block is unlinked by close(), at exit, or by the
+    multiprocessing resource tracker if this process dies without either. The free blocks
+    still take memory, nbytes() counts them too.
+    '''
+    def __init__(self):
+        self.blocks = {}
+        self.free = []
+        atexit.register(self.close)
+
+    def acquire(self, shape, dtype):
+        '''
+        Get a block for an array, returns its descriptor
+        '''
+        dtype = np.dtype(dtype)
+        block = self.fit(array_bytes(shape, dtype))
+        if block is not None:
+            self.free.remove(block)
+        else:
+            # The free blocks are all too small, drop them rather than letting them pile up
+            for block in self.free:
+                self.unlink(block)
+            self.free = []
+            block = shared_memory.SharedMemory(create=True, size=array_bytes(shape, dtype))
+            self.blocks[block.name] = block
+        return SharedArray(block.name, tuple(shape), dtype.str)
+
+    def fit(self, nbytes):
+        '''
+        The smallest free block that holds nbytes, None if there is none
+        '''
+        fits = [block for block in self.free if block.size >= nbytes]
+        return min(fits, key=lambda block: block.size) if fits else None
+
+    def nbytes(self):
+        '''
+        Bytes of all blocks, free or not
+        '''
+        return sum(block.size for block in self.blocks.values())
+
+    def nbytes_after(self, shape, dtype):
+        '''
+        What nbytes() will be after acquire(shape, dtype)
+        '''
+        nbytes = array_bytes(shape, dtype)
+        if self.fit(nbytes) is not None:
+            return self.nbytes()
+        return self.nbytes() - sum(block.size for block in self.free) + nbytes
+
+    def release(self, array):
+        '''
+        Hand the block of an array back for reuse
+        '''
+        self.free.append(self.blocks[array.name])
+
+    def unlink(self, block):
+        del self.blocks[block.name]
+        block.close()
+        block.unlink()
+
+    def close(self):
+        for block in list(self.blocks.values()):
+            self.unlink(block)
+        self.free = []
+
+
+def array_bytes(shape, dtype):
+    return max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+
+
+def attach_array(array):
+    '''
+    Attach to a shared array described by a SharedArray, returns the block and the array on
+    it. Close the block once the array is no longer used.
+    '''
+    block = shared_memory.SharedMemory(name=array.name)
+    return block, np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+
+
+def parse_roi(roi):
+    '''
+    Parse a region given as X,Y,WIDTH,HEIGHT
+    '''
+    try:
+        x, y, width, height = [int(value) for value in roi.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('the region has to be X,Y,WIDTH,HEIGHT, e.g. 1000,2000,512,512')
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError('the region needs a positive width and height')
+    return x, y, width, height
+
+
+def parse_size(size):
+    '''
+    Convert a size such as 512M or 8G to bytes
+    '''
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    size = size.strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def nat_key(key):
     '''
     A key to use with the `sorted()` function to sort naturally.